@@ -0,0 +1,512 @@
+"""Offline stand-in for the Spotify endpoints used by spotify-downloader.
+
+Serves generated fixtures for every ``SpotifyApi`` endpoint (home page, gid
+metadata, albums, paginated playlists, credits, lyrics, seektables and
+storage-resolve), synthetic MP4 files as the CDN and cover images, with
+optional latency, 429 injection and per-host CDN slowness.
+"""
+from __future__ import annotations
+
+import http.server
+import json
+import random
+import re
+import struct
+import sys
+import threading
+import time
+import urllib.parse
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from spotify_downloader.downloader import Downloader
+from spotify_downloader.downloader_song import DownloaderSong
+from spotify_downloader.spotify_api import SpotifyApi
+
+FAKE_DECRYPTION_KEY = "00" * 16
+FAKE_JPEG = b"\xff\xd8\xff\xe0" + b"\x00" * 1020 + b"\xff\xd9"
+
+
+def _atom(name: bytes, payload: bytes) -> bytes:
+    return struct.pack(">I4s", 8 + len(payload), name) + payload
+
+
+def _full_atom(name: bytes, payload: bytes, flags: int = 0) -> bytes:
+    return _atom(name, struct.pack(">I", flags) + payload)
+
+
+def get_synthetic_mp4(size: int) -> bytes:
+    ftyp = _atom(b"ftyp", b"M4A \x00\x00\x02\x00M4A isomiso2")
+    mvhd = _full_atom(
+        b"mvhd",
+        struct.pack(">IIII", 0, 0, 1000, 30000)
+        + b"\x00\x01\x00\x00\x01\x00"
+        + b"\x00" * 10
+        + struct.pack(">9I", 0x10000, 0, 0, 0, 0x10000, 0, 0, 0, 0x40000000)
+        + b"\x00" * 24
+        + struct.pack(">I", 2),
+    )
+    mdhd = _full_atom(
+        b"mdhd",
+        struct.pack(">IIII", 0, 0, 44100, 44100 * 30) + b"\x55\xc4\x00\x00",
+    )
+    hdlr = _full_atom(b"hdlr", b"\x00" * 4 + b"soun" + b"\x00" * 13)
+    esds = _full_atom(
+        b"esds",
+        b"\x03\x19\x00\x00\x00\x04\x11\x40\x15\x00\x00\x00\x00\x01\xf4\x00"
+        b"\x00\x01\xf4\x00\x05\x02\x12\x10\x06\x01\x02",
+    )
+    mp4a = _atom(
+        b"mp4a",
+        b"\x00" * 6
+        + struct.pack(">H", 1)
+        + b"\x00" * 8
+        + struct.pack(">HHHHI", 2, 16, 0, 0, 44100 << 16)
+        + esds,
+    )
+    stsd = _full_atom(b"stsd", struct.pack(">I", 1) + mp4a)
+    mdia = _atom(b"mdia", mdhd + hdlr + _atom(b"minf", _atom(b"stbl", stsd)))
+    trak = _atom(b"trak", _full_atom(b"tkhd", b"\x00" * 80, flags=1) + mdia)
+    payload = b"\x00" * max(size - len(ftyp) - len(mvhd) - len(trak) - 24, 0)
+    return ftyp + _atom(b"moov", mvhd + trak) + _atom(b"mdat", payload)
+
+
+class QuietServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # The downloader hangs up on slow hosts and on responses it has split
+        if isinstance(sys.exc_info()[1], ConnectionError):
+            return
+        super().handle_error(request, client_address)
+
+
+class FakeSpotify:
+    PLAYLIST_PAGE_SIZE = 100
+    ALBUM_PAGE_SIZE = 50
+
+    def __init__(
+        self,
+        tracks: int = 10,
+        tracks_per_album: int = 10,
+        audio_size: int = 64 * 1024,
+        latency: float = 0.0,
+        throttle_rate: float = 0.0,
+        retry_after: int = 0,
+        cdn_hosts: int = 2,
+        cdn_rates: list[float] = None,
+        seed: int = 0,
+    ):
+        self.tracks = tracks
+        self.tracks_per_album = tracks_per_album
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.cdn_hosts = cdn_hosts
+        self.cdn_rates = cdn_rates or []
+        self.audio = get_synthetic_mp4(audio_size)
+        self.random = random.Random(seed)
+        self.requests = 0
+        self.throttled = 0
+        self._lock = threading.Lock()
+        self.playlist_id = self.get_id(0xF << 124)
+        self.server = None
+        self.cdn_servers = []
+
+    @staticmethod
+    def get_id(number: int) -> str:
+        return SpotifyApi.gid_to_track_id(f"{number:032x}")
+
+    @staticmethod
+    def get_gid(track_id: str) -> str:
+        return SpotifyApi.track_id_to_gid(track_id)
+
+    def get_track_number(self, track_id: str) -> int:
+        return int(self.get_gid(track_id), 16) - 1
+
+    def get_album_number(self, album_id: str) -> int:
+        return int(self.get_gid(album_id), 16) - (0xA << 124)
+
+    def get_track_id(self, index: int) -> str:
+        return self.get_id(index + 1)
+
+    def get_album_id(self, album_index: int) -> str:
+        return self.get_id((0xA << 124) + album_index)
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.server.server_port}"
+
+    @property
+    def playlist_url(self) -> str:
+        return f"https://open.spotify.com/playlist/{self.playlist_id}"
+
+    def get_album_tracks(self, album_index: int) -> range:
+        start = album_index * self.tracks_per_album
+        return range(start, min(start + self.tracks_per_album, self.tracks))
+
+    def get_simple_artist(self, index: int) -> dict:
+        return {"id": self.get_id((0xB << 124) + index), "name": f"Artist {index}"}
+
+    def get_album_stub(self, album_index: int) -> dict:
+        return {
+            "id": self.get_album_id(album_index),
+            "name": f"Album {album_index}",
+            "artists": [self.get_simple_artist(album_index % 97)],
+            "images": [{"url": "", "height": 640, "width": 640}],
+            "available_markets": ["US", "GB", "DE"],
+        }
+
+    def get_track(self, index: int) -> dict:
+        album_index = index // self.tracks_per_album
+        return {
+            "id": self.get_track_id(index),
+            "name": f"Track {index}",
+            "artists": [self.get_simple_artist(index % 89)],
+            "album": self.get_album_stub(album_index),
+            "disc_number": 1,
+            "track_number": index % self.tracks_per_album + 1,
+            "external_ids": {"isrc": f"QZ{index:010d}"},
+            "available_markets": ["US", "GB", "DE"],
+        }
+
+    def get_gid_metadata(self, index: int) -> dict:
+        album_index = index // self.tracks_per_album
+        album_gid = self.get_gid(self.get_album_id(album_index))
+        return {
+            "gid": self.get_gid(self.get_track_id(index)),
+            "name": f"Track {index}",
+            "number": index % self.tracks_per_album + 1,
+            "disc_number": 1,
+            "artist": [self.get_simple_artist(index % 89)],
+            "external_id": [{"type": "isrc", "id": f"QZ{index:010d}"}],
+            "album": {
+                "gid": album_gid,
+                "name": f"Album {album_index}",
+                "date": {"year": 2020, "month": 1, "day": 1},
+                "cover_group": {
+                    "image": [{"file_id": f"{album_index:040x}", "size": "LARGE"}]
+                },
+            },
+            "file": [
+                {"file_id": f"{index:040x}", "format": "MP4_128"},
+                {"file_id": f"{index + (1 << 100):040x}", "format": "MP4_256"},
+            ],
+        }
+
+    def get_page(self, items: list, offset: int, limit: int, total: int, next_url: str) -> dict:
+        return {
+            "items": items,
+            "offset": offset,
+            "limit": limit,
+            "total": total,
+            "next": (
+                f"{next_url}?offset={offset + limit}&limit={limit}"
+                if offset + limit < total
+                else None
+            ),
+        }
+
+    def get_playlist_page(self, offset: int, limit: int) -> dict:
+        return self.get_page(
+            [
+                {"track": self.get_track(index)}
+                for index in range(offset, min(offset + limit, self.tracks))
+            ],
+            offset,
+            limit,
+            self.tracks,
+            f"{self.base_url}/v1/playlists/{self.playlist_id}/tracks",
+        )
+
+    def get_album_page(self, album_index: int, offset: int, limit: int) -> dict:
+        album_tracks = self.get_album_tracks(album_index)
+        return self.get_page(
+            [
+                {
+                    "id": self.get_track_id(index),
+                    "name": f"Track {index}",
+                    "artists": [self.get_simple_artist(index % 89)],
+                    "disc_number": 1,
+                    "track_number": index - album_tracks.start + 1,
+                }
+                for index in album_tracks[offset : offset + limit]
+            ],
+            offset,
+            limit,
+            len(album_tracks),
+            f"{self.base_url}/v1/albums/{self.get_album_id(album_index)}/tracks",
+        )
+
+    def get_album(self, album_index: int) -> dict:
+        return {
+            **self.get_album_stub(album_index),
+            "copyrights": [{"text": "(P) 2020 Benchmark", "type": "P"}],
+            "label": "Benchmark Records",
+            "tracks": self.get_album_page(album_index, 0, self.ALBUM_PAGE_SIZE),
+        }
+
+    def get_lyrics(self, index: int) -> dict | None:
+        if index % 5 == 4:
+            return None
+        return {
+            "lyrics": {
+                "syncType": "LINE_SYNCED",
+                "lines": [
+                    {"startTimeMs": str(line * 2500), "words": f"Line {line} of {index}"}
+                    for line in range(40)
+                ],
+            }
+        }
+
+    def get_credits(self, index: int) -> dict:
+        return {
+            "roleCredits": [
+                {"roleTitle": "Performers", "artists": [{"name": f"Artist {index % 89}"}]},
+                {"roleTitle": "Writers", "artists": [{"name": "Writer"}]},
+                {"roleTitle": "Producers", "artists": [{"name": "Producer"}]},
+            ]
+        }
+
+    def get_storage_resolve(self, file_id: str) -> dict:
+        return {
+            "cdnurl": [
+                f"http://127.0.0.1:{cdn_server.server_port}/audio/{host}/{file_id}"
+                for host, cdn_server in enumerate(self.cdn_servers)
+            ]
+        }
+
+    def should_throttle(self) -> bool:
+        with self._lock:
+            self.requests += 1
+            if self.throttle_rate and self.random.random() < self.throttle_rate:
+                self.throttled += 1
+                return True
+        return False
+
+    def route(self, path: str, query: dict):
+        offset = int(query.get("offset", 0))
+        if match := re.fullmatch(r"/metadata/4/track/(\w+)", path):
+            return self.get_gid_metadata(int(match.group(1), 16) - 1)
+        if match := re.fullmatch(r"/v1/playlists/(\w+)/tracks", path):
+            return self.get_playlist_page(offset, int(query.get("limit", 100)))
+        if match := re.fullmatch(r"/v1/playlists/(\w+)", path):
+            if query.get("fields") == "snapshot_id":
+                return {"snapshot_id": f"snapshot-{self.tracks}"}
+            return {
+                "id": self.playlist_id,
+                "name": "Benchmark",
+                "snapshot_id": f"snapshot-{self.tracks}",
+                "tracks": self.get_playlist_page(0, self.PLAYLIST_PAGE_SIZE),
+            }
+        if match := re.fullmatch(r"/v1/albums/(\w+)/tracks", path):
+            return self.get_album_page(
+                self.get_album_number(match.group(1)),
+                offset,
+                int(query.get("limit", self.ALBUM_PAGE_SIZE)),
+            )
+        if match := re.fullmatch(r"/v1/albums", path):
+            return {
+                "albums": [
+                    self.get_album(self.get_album_number(album_id))
+                    for album_id in query["ids"].split(",")
+                ]
+            }
+        if match := re.fullmatch(r"/v1/albums/(\w+)", path):
+            return self.get_album(self.get_album_number(match.group(1)))
+        if match := re.fullmatch(r"/v1/tracks", path):
+            return {
+                "tracks": [
+                    self.get_track(self.get_track_number(track_id))
+                    for track_id in query["ids"].split(",")
+                ]
+            }
+        if match := re.fullmatch(r"/v1/tracks/(\w+)", path):
+            return self.get_track(self.get_track_number(match.group(1)))
+        if match := re.fullmatch(r"/track-credits-view/v0/experimental/(\w+)/credits", path):
+            return self.get_credits(self.get_track_number(match.group(1)))
+        if match := re.fullmatch(r"/color-lyrics/v2/track/(\w+)", path):
+            return self.get_lyrics(self.get_track_number(match.group(1)))
+        if match := re.fullmatch(r"/seektable/(\w+)\.json", path):
+            return {"pssh": "AAAAOHBzc2gAAAAA7e+LqXnWSs6jyCfc1R0h7QAAABgiEHRyYWNrXzEyODEzMzY2NkjjlJWbBg=="}
+        if match := re.fullmatch(r"/storage-resolve/v2/files/audio/interactive/11/(\w+)", path):
+            return self.get_storage_resolve(match.group(1))
+        return None
+
+    def get_handler(self) -> type:
+        fake_spotify = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def send_body(
+                self,
+                status: int,
+                body: bytes,
+                content_type: str,
+                headers: dict = None,
+                rate: float = None,
+            ):
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                if self.command == "HEAD":
+                    return
+                if not rate:
+                    self.wfile.write(body)
+                    return
+                # Simulates a slow CDN host by pacing the body to rate bytes/s
+                for offset in range(0, len(body), 16 * 1024):
+                    self.wfile.write(body[offset : offset + 16 * 1024])
+                    self.wfile.flush()
+                    time.sleep(16 * 1024 / rate)
+
+            def send_audio(self):
+                audio = fake_spotify.audio
+                host = int(self.path.split("/")[2])
+                rate = (
+                    fake_spotify.cdn_rates[host]
+                    if host < len(fake_spotify.cdn_rates)
+                    else None
+                )
+                range_match = re.fullmatch(
+                    r"bytes=(\d+)-(\d*)", self.headers.get("Range", "")
+                )
+                if range_match is None:
+                    self.send_body(
+                        200, audio, "audio/mp4", {"Accept-Ranges": "bytes"}, rate
+                    )
+                    return
+                start = int(range_match.group(1))
+                end = int(range_match.group(2) or len(audio) - 1)
+                if start >= len(audio):
+                    self.send_body(
+                        416, b"", "audio/mp4", {"Content-Range": f"bytes */{len(audio)}"}
+                    )
+                    return
+                end = min(end, len(audio) - 1)
+                self.send_body(
+                    206,
+                    audio[start : end + 1],
+                    "audio/mp4",
+                    {"Content-Range": f"bytes {start}-{end}/{len(audio)}"},
+                    rate,
+                )
+
+            def do_GET(self):
+                if fake_spotify.latency:
+                    time.sleep(fake_spotify.latency)
+                split_url = urllib.parse.urlsplit(self.path)
+                path = split_url.path
+                query = dict(urllib.parse.parse_qsl(split_url.query))
+                if path.startswith("/audio/"):
+                    self.send_audio()
+                    return
+                if path.startswith("/image/"):
+                    self.send_body(200, FAKE_JPEG, "image/jpeg")
+                    return
+                if path == "/":
+                    self.send_body(
+                        200,
+                        b'<script>{"accessToken":"fake-token",'
+                        b'"accessTokenExpirationTimestampMs":4102444800000,'
+                        b'"isPremium":false,"isAnonymous":false}</script>',
+                        "text/html",
+                    )
+                    return
+                if self.headers.get("authorization") not in (None, "Bearer fake-token"):
+                    self.send_body(401, b"{}", "application/json")
+                    return
+                if fake_spotify.should_throttle():
+                    self.send_body(
+                        429,
+                        b"",
+                        "application/json",
+                        {"Retry-After": str(fake_spotify.retry_after)},
+                    )
+                    return
+                response = fake_spotify.route(path, query)
+                if response is None:
+                    self.send_body(404, b"{}", "application/json")
+                    return
+                self.send_body(200, json.dumps(response).encode(), "application/json")
+
+            do_HEAD = do_GET
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                self.send_body(200, b"", "application/octet-stream")
+
+        return Handler
+
+    def start_server(self) -> QuietServer:
+        server = QuietServer(("127.0.0.1", 0), self.get_handler())
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+    def start(self) -> FakeSpotify:
+        self.server = self.start_server()
+        # Every CDN host is a separate server so that per-host statistics apply
+        self.cdn_servers = [self.start_server() for _ in range(self.cdn_hosts)]
+        return self
+
+    def stop(self):
+        for server in [self.server, *self.cdn_servers]:
+            server.shutdown()
+            server.server_close()
+
+    def get_spotify_api_class(self) -> type[SpotifyApi]:
+        base_url = self.base_url
+        return type(
+            "FakeSpotifyApi",
+            (SpotifyApi,),
+            {
+                "SPOTIFY_HOME_PAGE_URL": f"{base_url}/",
+                "GID_METADATA_API_URL": f"{base_url}/metadata/4/track/{{gid}}?market=from_token",
+                "LYRICS_API_URL": f"{base_url}/color-lyrics/v2/track/{{track_id}}",
+                "PSSH_API_URL": f"{base_url}/seektable/{{file_id}}.json",
+                "STREAM_URL_API_URL": (
+                    f"{base_url}/storage-resolve/v2/files/audio/interactive/11/"
+                    "{file_id}?version=10000000&product=9&platform=39&alt=json"
+                ),
+                "METADATA_API_URL": f"{base_url}/v1/{{type}}/{{track_id}}",
+                "SEVERAL_METADATA_API_URL": f"{base_url}/v1/{{type}}",
+                "TRACK_CREDITS_API_URL": (
+                    f"{base_url}/track-credits-view/v0/experimental/{{track_id}}/credits"
+                ),
+            },
+        )
+
+    def get_downloader_class(self) -> type[Downloader]:
+        return type(
+            "FakeDownloader",
+            (Downloader,),
+            {
+                "COVER_URL": f"{self.base_url}/image/{{file_id}}",
+                # Keys come from OfflineDownloaderSong, so no device is loaded
+                "set_cdm": lambda self: None,
+            },
+        )
+
+
+class OfflineDownloaderSong(DownloaderSong):
+    def __init__(self, *args, use_ffmpeg: bool = False, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.use_ffmpeg = use_ffmpeg
+
+    def get_decryption_key(self, pssh: str) -> str:
+        return FAKE_DECRYPTION_KEY
+
+    def remux_ffmpeg(self, decryption_key: str, encrypted_path: Path, fixed_path: Path) -> None:
+        if self.use_ffmpeg:
+            super().remux_ffmpeg(decryption_key, encrypted_path, fixed_path)
+        else:
+            self.downloader.process_executor.run(["cp", encrypted_path, fixed_path], "remux")
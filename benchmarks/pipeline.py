@@ -0,0 +1,229 @@
+"""End-to-end sync benchmark against the offline Spotify stand-in.
+
+Each playlist size runs in its own subprocess so that peak RSS is measured
+per size, and is synced twice so that the unchanged-snapshot skip is measured
+too. Run from the repository root:
+
+    python benchmarks/pipeline.py --sizes 10,1000,10000
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import logging
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Iterator
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from fake_spotify import FakeSpotify, OfflineDownloaderSong
+
+from spotify_downloader.cache import ImageCache, MetadataCache
+from spotify_downloader.enums import DownloadModeSong
+from spotify_downloader.library import LibraryIndex
+from spotify_downloader.metrics import RunMetrics
+from spotify_downloader.models import SyncResult
+from spotify_downloader.ratelimit import BandwidthScheduler
+from spotify_downloader.retry_session import RetrySession
+from spotify_downloader.store import AudioStore
+from spotify_downloader.syncer import Syncer
+
+
+def get_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", default="10,1000,10000")
+    parser.add_argument("--size", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--latency-ms", type=float, default=0)
+    parser.add_argument("--throttle-rate", type=float, default=0)
+    parser.add_argument("--audio-size", type=int, default=64 * 1024)
+    parser.add_argument("--tracks-per-album", type=int, default=10)
+    parser.add_argument(
+        "--cdn-rates",
+        default="",
+        help="Comma separated KiB/s limit per CDN host, 0 for unlimited (e.g. 32,0)",
+    )
+    parser.add_argument(
+        "--bandwidth-limit",
+        type=float,
+        default=0,
+        help="Global download cap in KiB/s, 0 for unlimited",
+    )
+    parser.add_argument("--max-host-connections", type=int)
+    parser.add_argument(
+        "--download-mode",
+        choices=[i.value for i in DownloadModeSong],
+        default=DownloadModeSong.NATIVE.value,
+    )
+    parser.add_argument("--request-rate", type=float, default=1000)
+    parser.add_argument("--metadata-workers", type=int, default=4)
+    parser.add_argument("--download-workers", type=int, default=4)
+    parser.add_argument("--remux-workers", type=int)
+    parser.add_argument("--tag-workers", type=int, default=2)
+    parser.add_argument("--lyrics", action="store_true")
+    parser.add_argument("--prune", action="store_true")
+    parser.add_argument("--ffmpeg", action="store_true", help="Remux with ffmpeg instead of copying")
+    parser.add_argument("--report-path", type=Path)
+    parser.add_argument("--verbose", action="store_true")
+    return parser
+
+
+class TimedSyncer(Syncer):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.first_change_at = None
+
+    def iter_changes(self, result: SyncResult) -> Iterator:
+        for change in super().iter_changes(result):
+            if self.first_change_at is None:
+                self.first_change_at = time.perf_counter()
+            yield change
+
+
+def run_size(args: argparse.Namespace) -> dict:
+    logging.basicConfig(
+        format="[%(levelname)-8s %(asctime)s] %(message)s",
+        datefmt="%H:%M:%S",
+        level=logging.DEBUG if args.verbose else logging.WARNING,
+    )
+    cdn_rates = [float(i) * 1024 for i in args.cdn_rates.split(",") if i]
+    fake_spotify = FakeSpotify(
+        tracks=args.size,
+        tracks_per_album=args.tracks_per_album,
+        audio_size=args.audio_size,
+        latency=args.latency_ms / 1000,
+        throttle_rate=args.throttle_rate,
+        cdn_hosts=max(len(cdn_rates), 2),
+        cdn_rates=cdn_rates,
+    ).start()
+    with tempfile.TemporaryDirectory(prefix="spotify-downloader-bench-") as work_dir:
+        work_path = Path(work_dir)
+        metrics = RunMetrics()
+        spotify_api = fake_spotify.get_spotify_api_class()(
+            cookies_path=None,
+            cache=MetadataCache(work_path / "cache.db"),
+            request_rate=args.request_rate,
+            metrics=metrics,
+        )
+        downloader = fake_spotify.get_downloader_class()(
+            spotify_api,
+            work_path / "temp",
+            image_cache=ImageCache(
+                work_path / "covers",
+                session=RetrySession(metrics=metrics),
+            ),
+        )
+        downloader_song = OfflineDownloaderSong(
+            downloader,
+            download_mode=DownloadModeSong(args.download_mode),
+            use_ffmpeg=args.ffmpeg,
+            bandwidth_scheduler=BandwidthScheduler(
+                args.bandwidth_limit * 1024 or None,
+                max_host_connections=args.max_host_connections,
+            ),
+        )
+        music_root = work_path / "music"
+        syncer = TimedSyncer(
+            downloader_song,
+            music_root,
+            AudioStore(music_root / ".store"),
+            library=LibraryIndex(music_root),
+            journal_path=work_path / "journal.db",
+            metadata_workers=args.metadata_workers,
+            download_workers=args.download_workers,
+            remux_workers=args.remux_workers,
+            tag_workers=args.tag_workers,
+            lyrics=args.lyrics,
+            prune=args.prune,
+            report_path=args.report_path,
+        )
+        batch_entries = [(fake_spotify.playlist_url, "playlist")]
+        start_time = time.perf_counter()
+        sync_result = syncer.sync(batch_entries)
+        elapsed = time.perf_counter() - start_time
+        requests = fake_spotify.requests
+        counters = dict(metrics.counters)
+        bandwidth = downloader_song.bandwidth_scheduler.metrics()
+        stages = {
+            stage: round(summary["p50"] * 1000, 2)
+            for stage, summary in metrics.get_stage_summary().items()
+        }
+        # The second run finds the playlist snapshot unchanged and skips it
+        metrics.reset()
+        second_start_time = time.perf_counter()
+        syncer.sync(batch_entries)
+        second_elapsed = time.perf_counter() - second_start_time
+        downloader_song.http_downloader.close()
+        spotify_api.cache.close()
+        result = {
+            "size": args.size,
+            "seconds": elapsed,
+            "first_page_seconds": syncer.first_change_at - start_time,
+            "tracks_per_second": args.size / elapsed if elapsed else 0,
+            "downloaded": counters.get("tracks_downloaded", 0),
+            "failed": len(sync_result.failures),
+            "requests": requests,
+            "throttled": fake_spotify.throttled,
+            "second_run_seconds": second_elapsed,
+            "second_run_requests": fake_spotify.requests - requests,
+            "second_run_skipped": metrics.counters["sources_unchanged"],
+            "cdn_failovers": counters.get("cdn_failovers", 0),
+            "cdn_hosts": downloader_song.http_downloader.get_host_summary(),
+            "bandwidth": bandwidth,
+            "peak_rss_mib": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            "stages": stages,
+        }
+    fake_spotify.stop()
+    return result
+
+
+def main() -> int:
+    args = get_parser().parse_args()
+    if args.size is not None:
+        print(json.dumps(run_size(args)))
+        return 0
+    child_args = [i for i in sys.argv[1:] if not i.startswith("--sizes")]
+    if "--sizes" in sys.argv:
+        index = sys.argv.index("--sizes")
+        child_args = sys.argv[1:index] + sys.argv[index + 2 :]
+    print(
+        f"{'tracks':>8} {'seconds':>9} {'1st page':>8} {'tracks/s':>9} "
+        f"{'failed':>7} {'requests':>9} {'429s':>6} {'2nd run':>8} {'peak RSS':>10}"
+    )
+    exit_code = 0
+    for size in [int(i) for i in args.sizes.split(",")]:
+        process = subprocess.run(
+            [sys.executable, __file__, "--size", str(size), *child_args],
+            stdout=subprocess.PIPE,
+            text=True,
+            env={**os.environ, "PYTHONPATH": str(Path(__file__).resolve().parent)},
+        )
+        if process.returncode != 0:
+            print(f"{size:>8} failed with exit code {process.returncode}")
+            exit_code = 1
+            continue
+        result = json.loads(process.stdout.splitlines()[-1])
+        print(
+            f"{result['size']:>8} {result['seconds']:>9.2f} {result['first_page_seconds']:>8.2f} "
+            f"{result['tracks_per_second']:>9.1f} {result['failed']:>7} "
+            f"{result['requests']:>9} {result['throttled']:>6} "
+            f"{result['second_run_seconds']:>8.2f} {result['peak_rss_mib']:>8.1f} MiB"
+        )
+        if args.bandwidth_limit:
+            print(
+                "         achieved "
+                f"{result['bandwidth']['bytes_per_second'] / 1024:.1f} KiB/s "
+                f"of {args.bandwidth_limit:.1f} KiB/s"
+            )
+        if args.verbose:
+            print(f"         p50 ms per stage: {result['stages']}")
+    return exit_code
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,98 @@
+"""Startup-time benchmark for the spotify-downloader CLI.
+
+Runs ``python -X importtime`` on the CLI module and times ``--help``, then
+fails when heavy modules are imported eagerly or when startup exceeds the
+given budgets. Run from the repository root:
+
+    python benchmarks/startup.py
+"""
+from __future__ import annotations
+
+import argparse
+import re
+import statistics
+import subprocess
+import sys
+import time
+
+# Modules that must only be imported on the code paths that use them
+LAZY_MODULES = (
+    "yt_dlp",
+    "pywidevine",
+    "mutagen",
+    "requests",
+    "spotify_downloader.hardcoded_wvd",
+    "spotify_downloader.spotify_api",
+    "spotify_downloader.downloader",
+)
+IMPORTTIME_REGEX = r"import time:\s+(\d+) \|\s+(\d+) \|(\s*)(\S+)"
+
+
+def get_import_times(module: str) -> list[tuple[str, int]]:
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    import_times = []
+    for line in result.stderr.splitlines():
+        match = re.match(IMPORTTIME_REGEX, line)
+        if match is not None:
+            import_times.append((match.group(4), int(match.group(2))))
+    return import_times
+
+
+def time_help(runs: int) -> list[float]:
+    timings = []
+    for _ in range(runs):
+        start_time = time.perf_counter()
+        subprocess.run(
+            [sys.executable, "-m", "spotify_downloader", "--help"],
+            stdout=subprocess.DEVNULL,
+            check=True,
+        )
+        timings.append(time.perf_counter() - start_time)
+    return timings
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--max-import-ms", type=float, default=150)
+    parser.add_argument("--max-help-ms", type=float, default=500)
+    parser.add_argument("--top", type=int, default=10)
+    args = parser.parse_args()
+
+    import_times = get_import_times("spotify_downloader.main")
+    imported = {name for name, _ in import_times}
+    total_import_ms = next(
+        cumulative for name, cumulative in import_times
+        if name == "spotify_downloader.main"
+    ) / 1000
+    print(f"import spotify_downloader.main: {total_import_ms:.1f} ms")
+    for name, cumulative in sorted(import_times, key=lambda i: -i[1])[: args.top]:
+        print(f"  {cumulative / 1000:8.1f} ms  {name}")
+
+    help_timings = time_help(args.runs)
+    help_ms = statistics.median(help_timings) * 1000
+    print(f"spotify-downloader --help: {help_ms:.1f} ms (median of {args.runs})")
+
+    failures = [
+        f"{module} is imported at startup"
+        for module in LAZY_MODULES
+        if module in imported
+    ]
+    if total_import_ms > args.max_import_ms:
+        failures.append(
+            f"import took {total_import_ms:.1f} ms (budget {args.max_import_ms} ms)"
+        )
+    if help_ms > args.max_help_ms:
+        failures.append(f"--help took {help_ms:.1f} ms (budget {args.max_help_ms} ms)")
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,272 @@
+from __future__ import annotations
+
+import collections
+import functools
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Any, Callable
+
+import requests
+
+from .retry_session import RetrySession
+
+_MISSING = object()
+
+
+class MetadataCache:
+    DEFAULT_TTLS = {
+        "gid_metadata": 7 * 24 * 60 * 60,
+        "album": 7 * 24 * 60 * 60,
+        "track": 7 * 24 * 60 * 60,
+        "track_credits": 7 * 24 * 60 * 60,
+        "lyrics": 7 * 24 * 60 * 60,
+        "playlist": 10 * 60,
+        "playlist_pages": 10 * 60,
+        "playlist_page": 10 * 60,
+        "token": 60 * 60,
+    }
+    DEFAULT_TTL = 24 * 60 * 60
+    ACCESS_GRANULARITY = 60 * 60
+
+    def __init__(
+        self,
+        path: Path | str = ":memory:",
+        ttls: dict[str, float] = None,
+        max_entries: int = 100_000,
+        max_size: int = 512 * 1024 * 1024,
+    ):
+        self.path = path
+        self.ttls = {**self.DEFAULT_TTLS, **(ttls or {})}
+        self.max_entries = max_entries
+        self.max_size = max_size
+        self.hits = collections.Counter()
+        self.misses = collections.Counter()
+        self._lock = threading.RLock()
+        self._key_locks = {}
+        self._setup_database()
+
+    def _setup_database(self):
+        if self.path != ":memory:":
+            Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        self.connection = sqlite3.connect(str(self.path), check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS entries (
+                endpoint TEXT NOT NULL,
+                key TEXT NOT NULL,
+                value TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                accessed_at REAL NOT NULL,
+                PRIMARY KEY (endpoint, key)
+            )
+            """
+        )
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS entries_accessed_at ON entries (accessed_at)"
+        )
+        self.connection.commit()
+        self.entries, self.size = self.connection.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries"
+        ).fetchone()
+
+    def get_ttl(self, endpoint: str) -> float:
+        return self.ttls.get(endpoint, self.DEFAULT_TTL)
+
+    def get(self, endpoint: str, key: str, default: Any = _MISSING) -> Any:
+        now = time.time()
+        with self._lock:
+            row = self.connection.execute(
+                "SELECT value, size, created_at, accessed_at FROM entries "
+                "WHERE endpoint = ? AND key = ?",
+                (endpoint, key),
+            ).fetchone()
+            if row is not None and row[2] + self.get_ttl(endpoint) < now:
+                self._delete(endpoint, key, row[1])
+                self.connection.commit()
+                row = None
+            if row is None:
+                self.misses[endpoint] += 1
+                return default
+            if row[3] + self.ACCESS_GRANULARITY < now:
+                self.connection.execute(
+                    "UPDATE entries SET accessed_at = ? WHERE endpoint = ? AND key = ?",
+                    (now, endpoint, key),
+                )
+                self.connection.commit()
+            self.hits[endpoint] += 1
+        return json.loads(row[0])
+
+    def set(self, endpoint: str, key: str, value: Any):
+        now = time.time()
+        serialized = json.dumps(value, separators=(",", ":"))
+        with self._lock:
+            row = self.connection.execute(
+                "SELECT size FROM entries WHERE endpoint = ? AND key = ?",
+                (endpoint, key),
+            ).fetchone()
+            if row is not None:
+                self.entries -= 1
+                self.size -= row[0]
+            self.connection.execute(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?)",
+                (endpoint, key, serialized, len(serialized), now, now),
+            )
+            self.entries += 1
+            self.size += len(serialized)
+            self._evict()
+            self.connection.commit()
+
+    def get_or_fetch(self, endpoint: str, key: str, fetch: Callable[[], Any]) -> Any:
+        with self._lock:
+            key_lock = self._key_locks.setdefault((endpoint, key), threading.Lock())
+        try:
+            with key_lock:
+                value = self.get(endpoint, key)
+                if value is _MISSING:
+                    value = fetch()
+                    self.set(endpoint, key, value)
+        finally:
+            with self._lock:
+                self._key_locks.pop((endpoint, key), None)
+        return value
+
+    def invalidate(self, endpoint: str, key: str):
+        with self._lock:
+            row = self.connection.execute(
+                "SELECT size FROM entries WHERE endpoint = ? AND key = ?",
+                (endpoint, key),
+            ).fetchone()
+            if row is not None:
+                self._delete(endpoint, key, row[0])
+                self.connection.commit()
+
+    def _delete(self, endpoint: str, key: str, size: int):
+        self.connection.execute(
+            "DELETE FROM entries WHERE endpoint = ? AND key = ?",
+            (endpoint, key),
+        )
+        self.entries -= 1
+        self.size -= size
+
+    def _evict(self):
+        while self.entries > self.max_entries or self.size > self.max_size:
+            rows = self.connection.execute(
+                "SELECT endpoint, key, size FROM entries ORDER BY accessed_at LIMIT 100"
+            ).fetchall()
+            if not rows:
+                break
+            for endpoint, key, size in rows:
+                if self.entries <= self.max_entries and self.size <= self.max_size:
+                    break
+                self._delete(endpoint, key, size)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": self.entries,
+                "size": self.size,
+                "hits": dict(self.hits),
+                "misses": dict(self.misses),
+            }
+
+    def close(self):
+        with self._lock:
+            self.connection.close()
+
+
+def get_cache_key(key: str, args: tuple, kwargs: dict) -> str:
+    return ":".join(str(i) for i in (key, *args, *sorted(kwargs.items())))
+
+
+def cached(endpoint: str):
+    def decorator(func: Callable) -> Callable:
+        @functools.wraps(func)
+        def wrapper(self, key: str, *args, **kwargs):
+            cache_key = get_cache_key(key, args, kwargs)
+            return self.cache.get_or_fetch(
+                endpoint,
+                cache_key,
+                lambda: func(self, key, *args, **kwargs),
+            )
+
+        return wrapper
+
+    return decorator
+
+
+class ImageCache:
+    def __init__(
+        self,
+        path: Path = Path("./cover_cache"),
+        max_size: int = 256 * 1024 * 1024,
+        session: requests.Session = None,
+        timeout: float = 30,
+    ):
+        self.path = path
+        self.max_size = max_size
+        self.session = session if session is not None else RetrySession()
+        self.timeout = timeout
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._url_locks = {}
+        self._setup_directory()
+
+    def _setup_directory(self):
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.size = sum(i.stat().st_size for i in self.path.glob("*.img"))
+
+    def get_image_path(self, url: str) -> Path:
+        return self.path / f"{hashlib.sha1(url.encode('utf8')).hexdigest()}.img"
+
+    def get(self, url: str) -> bytes:
+        image_path = self.get_image_path(url)
+        with self._lock:
+            url_lock = self._url_locks.setdefault(url, threading.Lock())
+        try:
+            with url_lock:
+                if image_path.exists():
+                    os.utime(image_path)
+                    with self._lock:
+                        self.hits += 1
+                    return image_path.read_bytes()
+                response = self.session.get(url, timeout=self.timeout)
+                response.raise_for_status()
+                image_bytes = response.content
+                temp_path = image_path.with_suffix(".tmp")
+                temp_path.write_bytes(image_bytes)
+                os.replace(temp_path, image_path)
+                with self._lock:
+                    self.misses += 1
+                    self.size += len(image_bytes)
+                    self._evict()
+        finally:
+            with self._lock:
+                self._url_locks.pop(url, None)
+        return image_bytes
+
+    def _evict(self):
+        if self.size <= self.max_size:
+            return
+        for image_path in sorted(
+            self.path.glob("*.img"), key=lambda i: i.stat().st_mtime
+        ):
+            if self.size <= self.max_size:
+                break
+            self.size -= image_path.stat().st_size
+            image_path.unlink(missing_ok=True)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "size": self.size,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
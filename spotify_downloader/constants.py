@@ -4,6 +4,7 @@ MP4_TAGS_MAP = {
     "artist": "\xa9ART",
     "composer": "\xa9wrt",
     "copyright": "cprt",
+    "lyrics": "\xa9lyr",
     "media_type": "stik",
     "producer": "\xa9prd",
     "release_date": "\xa9day",
@@ -1,25 +1,23 @@
 from __future__ import annotations
 
 import datetime
-import functools
 import re
 import shutil
 import subprocess
 from pathlib import Path
+from typing import Iterator
 
-import requests
-from mutagen.mp4 import MP4, MP4Cover, MP4FreeForm
-from pywidevine import Cdm, Device
-
+from .cache import ImageCache
 from .constants import *
 from .enums import RemuxMode
-from .hardcoded_wvd import HARDCODED_WVD
 from .models import DownloadQueueItem, UrlInfo
+from .process_executor import ProcessExecutor
 from .spotify_api import SpotifyApi
 
 
 class Downloader:
     ILLEGAL_CHARACTERS_REGEX = r'[\\/:*?"<>|;]'
+    COVER_URL = "https://i.scdn.co/image/{file_id}"
 
     def __init__(
         self,
@@ -36,6 +34,8 @@ class Downloader:
         exclude_tags: str = None,
         truncate: int = 40,
         silence: bool = False,
+        image_cache: ImageCache = None,
+        process_executor: ProcessExecutor = None,
     ):
         self.spotify_api = spotify_api
         self.temp_path = temp_path
@@ -50,6 +50,12 @@ class Downloader:
         self.exclude_tags = exclude_tags
         self.truncate = truncate
         self.silence = silence
+        self.image_cache = image_cache if image_cache is not None else ImageCache()
+        self.process_executor = (
+            process_executor
+            if process_executor is not None
+            else ProcessExecutor(metrics=spotify_api.metrics)
+        )
         self._set_binaries_full_path()
         self._set_exclude_tags_list()
         self._set_truncate()
@@ -82,9 +88,13 @@ class Downloader:
             self.subprocess_additional_args = {}
 
     def set_cdm(self) -> None:
+        from pywidevine import Cdm, Device
+
         if self.wvd_path:
             self.cdm = Cdm.from_device(Device.load(self.wvd_path))
         else:
+            from .hardcoded_wvd import HARDCODED_WVD
+
             self.cdm = Cdm.from_device(Device.loads(HARDCODED_WVD))
 
     def get_url_info(self, url: str) -> UrlInfo:
@@ -93,17 +103,55 @@ class Downloader:
             raise Exception("Invalid URL")
         return UrlInfo(type=url_regex_result.group(1), id=url_regex_result.group(2))
 
-    def get_download_queue(self, url_info: UrlInfo) -> list[DownloadQueueItem]:
-        download_queue = []
-        download_queue.extend(
-            [
-                DownloadQueueItem(metadata=track_metadata["track"])
-                for track_metadata in self.spotify_api.get_playlist(url_info.id)[
-                    "tracks"
-                ]["items"]
-            ]
+    def prefetch_tracks(self, urls: list[str]):
+        track_ids = []
+        for url in urls:
+            try:
+                url_info = self.get_url_info(url)
+            except Exception:
+                continue
+            if url_info.type == "track":
+                track_ids.append(url_info.id)
+        if track_ids:
+            self.spotify_api.get_tracks(track_ids)
+
+    @staticmethod
+    def get_queue_item(track: dict, album: dict = None) -> DownloadQueueItem:
+        album = album if album is not None else track["album"]
+        return DownloadQueueItem(
+            id=track["id"],
+            name=track["name"],
+            artists=tuple(artist["name"] for artist in track["artists"]),
+            album_id=album.get("id"),
+            album_name=album["name"],
+            album_artist=album["artists"][0]["name"],
+            isrc=track.get("external_ids", {}).get("isrc"),
         )
-        return download_queue
+
+    def iter_download_queue(self, url_info: UrlInfo) -> Iterator[list[DownloadQueueItem]]:
+        if url_info.type == "track":
+            yield [self.get_queue_item(self.spotify_api.get_track(url_info.id))]
+        elif url_info.type == "album":
+            album = self.spotify_api.get_album(url_info.id)
+            yield [
+                self.get_queue_item(track_metadata, album)
+                for track_metadata in album["tracks"]["items"]
+            ]
+        else:
+            for playlist_items in self.spotify_api.iter_playlist_pages(url_info.id):
+                yield [
+                    self.get_queue_item(track_metadata["track"])
+                    for track_metadata in playlist_items
+                    if track_metadata["track"] is not None
+                    and track_metadata["track"]["id"] is not None
+                ]
+
+    def get_download_queue(self, url_info: UrlInfo) -> list[DownloadQueueItem]:
+        return [
+            queue_item
+            for queue_page in self.iter_download_queue(url_info)
+            for queue_item in queue_page
+        ]
 
     def get_sanitized_string(self, dirty_string: str, is_folder: bool) -> str:
         dirty_string = re.sub(self.ILLEGAL_CHARACTERS_REGEX, "_", dirty_string)
@@ -149,12 +197,18 @@ class Downloader:
             + f' & {artist_list[-1]["name"]}'
         )
 
-    def get_cover_url(self, metadata_gid: dict, size: str) -> str:
-        return "https://i.scdn.co/image/" + next(
-            i["file_id"]
-            for i in metadata_gid["album"]["cover_group"]["image"]
-            if i["size"] == size
+    def get_cover_url(self, metadata_gid: dict, size: str) -> str | None:
+        cover_file_id = next(
+            (
+                i["file_id"]
+                for i in metadata_gid["album"].get("cover_group", {}).get("image", [])
+                if i["size"] == size
+            ),
+            None,
         )
+        if cover_file_id is None:
+            return None
+        return self.COVER_URL.format(file_id=cover_file_id)
 
     def decrypt_mp4decrypt(
         self,
@@ -162,7 +216,7 @@ class Downloader:
         decrypted_path: Path,
         decryption_key: str,
     ):
-        subprocess.run(
+        self.process_executor.run(
             [
                 self.mp4decrypt_path_full,
                 encrypted_path,
@@ -170,16 +224,15 @@ class Downloader:
                 f"1:{decryption_key}",
                 decrypted_path,
             ],
-            check=True,
-            **self.subprocess_additional_args,
+            "decrypt",
         )
 
-    @staticmethod
-    @functools.lru_cache()
-    def get_image_bytes(url: str) -> bytes:
-        return requests.get(url).content
+    def get_image_bytes(self, url: str) -> bytes:
+        return self.image_cache.get(url)
 
     def apply_tags(self, fixed_location: Path, tags: dict):
+        from mutagen.mp4 import MP4, MP4Cover, MP4FreeForm
+
         to_apply_tags = [
             tag_name
             for tag_name in tags.keys()
@@ -198,6 +251,14 @@ class Downloader:
                 mp4_tags["----:com.apple.iTunes:ISRC"] = [
                     MP4FreeForm(tags["isrc"].encode("utf-8"))
                 ]
+            elif tag_name == "cover":
+                if tags["cover"] is not None:
+                    mp4_tags["covr"] = [
+                        MP4Cover(
+                            self.get_image_bytes(tags["cover"]),
+                            imageformat=MP4Cover.FORMAT_JPEG,
+                        )
+                    ]
             elif tag_name == "label":
                 mp4_tags["----:com.apple.iTunes:LABEL"] = [
                     MP4FreeForm(tags["label"].encode("utf-8"))
@@ -216,9 +277,9 @@ class Downloader:
         final_path.parent.mkdir(parents=True, exist_ok=True)
         shutil.move(fixed_path, final_path)
 
-    @functools.lru_cache()
     def save_cover(self, cover_path: Path, cover_url: str):
-        cover_path.write_bytes(self.get_image_bytes(cover_url))
+        if not cover_path.exists():
+            cover_path.write_bytes(self.get_image_bytes(cover_url))
 
     def cleanup_temp_path(self):
         shutil.rmtree(self.temp_path)
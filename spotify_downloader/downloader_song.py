@@ -1,13 +1,12 @@
-import datetime
 import subprocess
+import threading
 from pathlib import Path
 
-from pywidevine import PSSH
-from yt_dlp import YoutubeDL
-
 from .downloader import Downloader
 from .enums import DownloadModeSong, RemuxMode
+from .http_downloader import HttpDownloader
 from .models import Lyrics
+from .ratelimit import BandwidthScheduler
 
 
 class DownloaderSong:
@@ -17,17 +16,38 @@ class DownloaderSong:
         template_file_single_disc: str = "{track:02d} {title}", # i want to remove this but it causes an error
         download_mode: DownloadModeSong = DownloadModeSong.YTDLP,
         premium: bool = False,
+        stream: bool = False,
+        cover_size: str = "LARGE",
+        bandwidth_scheduler: BandwidthScheduler = None,
     ):
         self.downloader = downloader
         self.template_file_single_disc = template_file_single_disc # remove me pls
         self.download_mode = download_mode
         self.premium = premium
+        self.stream = stream
+        self.cover_size = cover_size
+        self.bandwidth_scheduler = (
+            bandwidth_scheduler
+            if bandwidth_scheduler is not None
+            else BandwidthScheduler()
+        )
+        self._album_tags = {}
+        self._album_tags_lock = threading.Lock()
         self._set_codec()
+        self._set_http_downloader()
 
     def _set_codec(self):
         self.codec = "MP4_256" if self.premium else "MP4_128"
 
+    def _set_http_downloader(self):
+        self.http_downloader = HttpDownloader(
+            metrics=self.downloader.spotify_api.metrics,
+            bandwidth_scheduler=self.bandwidth_scheduler,
+        )
+
     def get_decryption_key(self, pssh: str) -> str:
+        from pywidevine import PSSH
+
         try:
             pssh = PSSH(pssh)
             cdm_session = self.downloader.cdm.open()
@@ -52,10 +72,42 @@ class DownloaderSong:
                 return None
         return next(i["file_id"] for i in audio_files if i["format"] == self.codec)
 
+    def get_album_tags(self, album_metadata: dict) -> dict:
+        with self._album_tags_lock:
+            album_tags = self._album_tags.get(album_metadata["id"])
+        if album_tags is not None:
+            return album_tags
+        track_totals = {}
+        for track in album_metadata["tracks"]["items"]:
+            track_totals[track["disc_number"]] = max(
+                track_totals.get(track["disc_number"], 0), track["track_number"]
+            )
+        album_tags = {
+            "album": album_metadata["name"],
+            "album_artist": self.downloader.get_artist(album_metadata["artists"]),
+            "copyright": next(
+                (i["text"] for i in album_metadata["copyrights"] if i["type"] == "P"),
+                None,
+            ),
+            "disc_total": album_metadata["tracks"]["items"][-1]["disc_number"],
+            "label": album_metadata.get("label"),
+            "track_totals": track_totals,
+        }
+        with self._album_tags_lock:
+            self._album_tags[album_metadata["id"]] = album_tags
+        return album_tags
+
+    def get_album_tags_by_id(self, album_id: str) -> dict:
+        with self._album_tags_lock:
+            album_tags = self._album_tags.get(album_id)
+        if album_tags is not None:
+            return album_tags
+        return self.get_album_tags(self.downloader.spotify_api.get_album(album_id))
+
     def get_tags(
         self,
         metadata_gid: dict,
-        album_metadata: dict,
+        album_tags: dict,
         track_credits: dict,
     ) -> dict:
         isrc = None
@@ -77,18 +129,16 @@ class DownloaderSong:
             if role["roleTitle"] == "Writers"
         )["artists"]
         tags = {
-            "album": album_metadata["name"],
-            "album_artist": self.downloader.get_artist(album_metadata["artists"]),
+            "album": album_tags["album"],
+            "album_artist": album_tags["album_artist"],
             "artist": self.downloader.get_artist(metadata_gid["artist"]),
             "composer": self.downloader.get_artist(composers) if composers else None,
-            "copyright": next(
-                (i["text"] for i in album_metadata["copyrights"] if i["type"] == "P"),
-                None,
-            ),
+            "copyright": album_tags["copyright"],
+            "cover": self.downloader.get_cover_url(metadata_gid, self.cover_size),
             "disc": metadata_gid["disc_number"],
-            "disc_total": album_metadata["tracks"]["items"][-1]["disc_number"],
+            "disc_total": album_tags["disc_total"],
             "isrc": isrc.get("id") if isrc is not None else None,
-            "label": album_metadata.get("label"),
+            "label": album_tags["label"],
             "media_type": 1,
             "producer": self.downloader.get_artist(producers) if producers else None,
             "release_date": self.downloader.get_release_date_tag(
@@ -97,11 +147,7 @@ class DownloaderSong:
             "release_year": str(release_date_datetime_obj.year),
             "title": metadata_gid["name"],
             "track": metadata_gid["number"],
-            "track_total": max(
-                i["track_number"]
-                for i in album_metadata["tracks"]["items"]
-                if i["disc_number"] == metadata_gid["disc_number"]
-            ),
+            "track_total": album_tags["track_totals"][metadata_gid["disc_number"]],
             "url": f"https://open.spotify.com/track/{self.downloader.spotify_api.gid_to_track_id(metadata_gid['gid'])}",
         }
         return tags
@@ -110,14 +156,30 @@ class DownloaderSong:
         return self.downloader.get_artist(metadata_gid["artist"])
 
 
-    def download(self, encrypted_path: Path, stream_url: str):
+    def download(self, encrypted_path: Path, stream_urls: list[str]):
         if self.download_mode == DownloadModeSong.YTDLP:
-            self.download_ytdlp(encrypted_path, stream_url)
+            self.download_ytdlp(
+                encrypted_path, self.http_downloader.get_ordered_urls(stream_urls)[0]
+            )
         elif self.download_mode == DownloadModeSong.ARIA2C:
-            self.download_aria2c(encrypted_path, stream_url)
+            self.download_aria2c(encrypted_path, stream_urls)
+        elif self.download_mode == DownloadModeSong.NATIVE:
+            self.download_native(encrypted_path, stream_urls)
 
     def download_ytdlp(self, encrypted_path: Path, stream_url: str) -> None:
-        with YoutubeDL(
+        from yt_dlp import YoutubeDL
+
+        downloaded = [0]
+
+        def on_progress(status: dict):
+            downloaded_bytes = status.get("downloaded_bytes")
+            if downloaded_bytes is None:
+                return
+            # Progress hooks run on the downloading thread, so waiting here throttles yt-dlp
+            self.bandwidth_scheduler.consume(max(downloaded_bytes - downloaded[0], 0))
+            downloaded[0] = downloaded_bytes
+
+        with self.bandwidth_scheduler.slot(stream_url), YoutubeDL(
             {
                 "quiet": True,
                 "no_warnings": True,
@@ -126,29 +188,95 @@ class DownloaderSong:
                 "fixup": "never",
                 "allowed_extractors": ["generic"],
                 "noprogress": self.downloader.silence,
+                "progress_hooks": [on_progress],
             }
         ) as ydl:
             ydl.download(stream_url)
 
-    def download_aria2c(self, encrypted_path: Path, stream_url: str) -> None:
+    def download_native(self, encrypted_path: Path, stream_urls: list[str]) -> None:
+        self.http_downloader.download(stream_urls, encrypted_path)
+
+    def download_aria2c(self, encrypted_path: Path, stream_urls: list[str]) -> None:
         encrypted_path.parent.mkdir(parents=True, exist_ok=True)
-        subprocess.run(
-            [
-                self.downloader.aria2c_path_full,
-                "--no-conf",
-                "--download-result=hide",
-                "--console-log-level=error",
-                "--summary-interval=0",
-                "--file-allocation=none",
-                stream_url,
-                "--out",
-                encrypted_path,
-            ],
-            check=True,
-            **self.downloader.subprocess_additional_args,
-        )
+        stream_urls = self.http_downloader.get_ordered_urls(stream_urls)
+        with self.bandwidth_scheduler.slot(stream_urls[0]):
+            # aria2c can't share our token bucket, so it gets an even share of the cap
+            rate_share = self.bandwidth_scheduler.get_share()
+            subprocess.run(
+                [
+                    self.downloader.aria2c_path_full,
+                    "--no-conf",
+                    "--download-result=hide",
+                    "--console-log-level=error",
+                    "--summary-interval=0",
+                    "--file-allocation=none",
+                    *(
+                        [f"--max-overall-download-limit={int(rate_share)}"]
+                        if rate_share is not None
+                        else []
+                    ),
+                    # Every CDN URL is passed as a mirror of the same file
+                    *stream_urls,
+                    "--out",
+                    encrypted_path,
+                ],
+                check=True,
+                **self.downloader.subprocess_additional_args,
+            )
+        self.bandwidth_scheduler.record(encrypted_path.stat().st_size)
         print("\r", end="")
 
+    @property
+    def can_stream(self) -> bool:
+        return self.stream and self.downloader.remux_mode == RemuxMode.FFMPEG
+
+    def download_remux_stream(
+        self,
+        stream_urls: list[str],
+        remuxed_path: Path,
+        decryption_key: str,
+    ) -> None:
+        remuxed_path.parent.mkdir(parents=True, exist_ok=True)
+        stream_url = self.http_downloader.get_ordered_urls(stream_urls)[0]
+        with self.bandwidth_scheduler.slot(stream_url), self.http_downloader.session.get(
+            stream_url,
+            stream=True,
+            timeout=self.http_downloader.timeout,
+        ) as response:
+            response.raise_for_status()
+            process = subprocess.Popen(
+                [
+                    self.downloader.ffmpeg_path_full,
+                    "-loglevel",
+                    "error",
+                    "-y",
+                    "-decryption_key",
+                    decryption_key,
+                    "-i",
+                    "pipe:0",
+                    "-movflags",
+                    "+faststart",
+                    "-c",
+                    "copy",
+                    remuxed_path,
+                ],
+                stdin=subprocess.PIPE,
+                **self.downloader.subprocess_additional_args,
+            )
+            try:
+                for chunk in response.iter_content(
+                    chunk_size=self.http_downloader.chunk_size
+                ):
+                    self.bandwidth_scheduler.consume(len(chunk))
+                    process.stdin.write(chunk)
+            except BrokenPipeError:
+                pass
+            finally:
+                process.stdin.close()
+                process.wait()
+        if process.returncode != 0:
+            raise subprocess.CalledProcessError(process.returncode, process.args)
+
     def remux(
         self,
         encrypted_path: Path,
@@ -165,7 +293,7 @@ class DownloaderSong:
             self.remux_mp4box(decrypted_path, remuxed_path)
 
     def remux_mp4box(self, decrypted_path: Path, remuxed_path: Path):
-        subprocess.run(
+        self.downloader.process_executor.run(
             [
                 self.downloader.mp4box_path_full,
                 "-quiet",
@@ -177,8 +305,7 @@ class DownloaderSong:
                 "-new",
                 remuxed_path,
             ],
-            check=True,
-            **self.downloader.subprocess_additional_args,
+            "remux",
         )
 
     def remux_ffmpeg(
@@ -187,7 +314,7 @@ class DownloaderSong:
         encrypted_path: Path,
         fixed_path: Path,
     ) -> None:
-        subprocess.run(
+        self.downloader.process_executor.run(
             [
                 self.downloader.ffmpeg_path_full,
                 "-loglevel",
@@ -203,28 +330,28 @@ class DownloaderSong:
                 "copy",
                 fixed_path,
             ],
-            check=True,
-            **self.downloader.subprocess_additional_args,
+            "remux",
         )
 
     def get_lyrics_synced_timestamp_lrc(self, time: int) -> str:
-        lrc_timestamp = datetime.datetime.fromtimestamp(
-            time / 1000.0, tz=datetime.timezone.utc
-        )
-        return lrc_timestamp.strftime("%M:%S.%f")[:-4]
+        minutes, milliseconds = divmod(time, 60_000)
+        seconds, milliseconds = divmod(milliseconds, 1000)
+        return f"{minutes:02d}:{seconds:02d}.{milliseconds // 10:02d}"
 
     def get_lyrics(self, track_id: str) -> Lyrics:
         lyrics = Lyrics()
         raw_lyrics = self.downloader.spotify_api.get_lyrics(track_id)
         if raw_lyrics is None:
             return lyrics
-        lyrics.synced = ""
-        lyrics.unsynced = ""
-        for line in raw_lyrics["lyrics"]["lines"]:
-            if raw_lyrics["lyrics"]["syncType"] == "LINE_SYNCED":
-                lyrics.synced += f'[{self.get_lyrics_synced_timestamp_lrc(int(line["startTimeMs"]))}]{line["words"]}\n'
-            lyrics.unsynced += f'{line["words"]}\n'
-        lyrics.unsynced = lyrics.unsynced[:-1]
+        lines = raw_lyrics["lyrics"]["lines"]
+        if raw_lyrics["lyrics"]["syncType"] == "LINE_SYNCED":
+            lyrics.synced = "".join(
+                f'[{self.get_lyrics_synced_timestamp_lrc(int(line["startTimeMs"]))}]{line["words"]}\n'
+                for line in lines
+            )
+        else:
+            lyrics.synced = ""
+        lyrics.unsynced = "\n".join(line["words"] for line in lines)
         return lyrics
 
     def get_cover_path(self, final_path: Path) -> Path:
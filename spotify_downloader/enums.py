@@ -6,4 +6,12 @@ class RemuxMode(Enum):
 
 class DownloadModeSong(Enum):
     YTDLP = "ytdlp"
-    ARIA2C = "aria2c"
\ No newline at end of file
+    ARIA2C = "aria2c"
+    NATIVE = "native"
+
+
+class LinkMode(Enum):
+    AUTO = "auto"
+    HARDLINK = "hardlink"
+    REFLINK = "reflink"
+    COPY = "copy"
@@ -0,0 +1,327 @@
+from __future__ import annotations
+
+import logging
+import os
+import re
+import threading
+import time
+import urllib.parse
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from .metrics import RunMetrics
+from .models import HostStats, RangeProgress
+from .ratelimit import BandwidthScheduler
+from .retry_session import RetrySession
+
+logger = logging.getLogger(__name__)
+
+
+class HttpDownloader:
+    CONTENT_RANGE_REGEX = r"bytes (\d+)-(\d+)/(\d+)"
+    UNSATISFIED_RANGE_REGEX = r"bytes \*/(\d+)"
+
+    def __init__(
+        self,
+        pool_size: int = 16,
+        chunk_size: int = 64 * 1024,
+        parallel_threshold: int = 8 * 1024 * 1024,
+        parallel_parts: int = 4,
+        timeout: float = 30,
+        min_throughput: float = 64 * 1024,
+        throughput_window: float = 2.0,
+        metrics: RunMetrics = None,
+        bandwidth_scheduler: BandwidthScheduler = None,
+    ):
+        self.pool_size = pool_size
+        self.chunk_size = chunk_size
+        self.parallel_threshold = parallel_threshold
+        self.parallel_parts = parallel_parts
+        self.timeout = timeout
+        self.min_throughput = min_throughput
+        self.throughput_window = throughput_window
+        self.metrics = metrics
+        self.bandwidth_scheduler = (
+            bandwidth_scheduler
+            if bandwidth_scheduler is not None
+            else BandwidthScheduler()
+        )
+        self.host_stats = {}
+        self.bytes_downloaded = 0
+        self.seconds_downloading = 0.0
+        self._lock = threading.Lock()
+        self._setup_session()
+        self._executor = ThreadPoolExecutor(
+            pool_size,
+            thread_name_prefix="http-part",
+        )
+
+    def _setup_session(self):
+        self.session = RetrySession(metrics=self.metrics)
+        # Requests that have another URL to fail over to aren't retried on the same host
+        self.failover_session = RetrySession(max_retries=0, metrics=self.metrics)
+        adapter = HTTPAdapter(
+            pool_connections=self.pool_size,
+            pool_maxsize=self.pool_size,
+        )
+        for session in (self.session, self.failover_session):
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+
+    @property
+    def bytes_per_second(self) -> float:
+        with self._lock:
+            if not self.seconds_downloading:
+                return 0.0
+            return self.bytes_downloaded / self.seconds_downloading
+
+    def _add_stats(self, downloaded: int, seconds: float):
+        with self._lock:
+            self.bytes_downloaded += downloaded
+            self.seconds_downloading += seconds
+
+    @staticmethod
+    def get_part_path(path: Path) -> Path:
+        return path.with_name(path.name + ".part")
+
+    @staticmethod
+    def get_parallel_path(path: Path) -> Path:
+        return path.with_name(path.name + ".parallel")
+
+    @staticmethod
+    def get_host(url: str) -> str:
+        return urllib.parse.urlsplit(url).netloc
+
+    def record_transfer(self, url: str, downloaded: int, seconds: float, failed: bool):
+        with self._lock:
+            host_stats = self.host_stats.setdefault(self.get_host(url), HostStats())
+            host_stats.requests += 1
+            host_stats.bytes += downloaded
+            host_stats.seconds += seconds
+            if failed:
+                host_stats.errors += 1
+
+    def get_host_score(self, url: str) -> float:
+        with self._lock:
+            host_stats = self.host_stats.get(self.get_host(url))
+            if host_stats is None or not host_stats.seconds:
+                return float("inf")
+            return host_stats.throughput * (1 - host_stats.error_rate)
+
+    def get_ordered_urls(self, urls: str | list[str]) -> list[str]:
+        if isinstance(urls, str):
+            return [urls]
+        return sorted(urls, key=self.get_host_score, reverse=True)
+
+    def get_host_summary(self) -> dict[str, dict]:
+        with self._lock:
+            return {
+                host: {
+                    "requests": host_stats.requests,
+                    "errors": host_stats.errors,
+                    "bytes": host_stats.bytes,
+                    "bytes_per_second": round(host_stats.throughput, 2),
+                }
+                for host, host_stats in self.host_stats.items()
+            }
+
+    def download(self, urls: str | list[str], path: Path) -> int:
+        urls = self.get_ordered_urls(urls)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        part_path = self.get_part_path(path)
+        parallel_path = self.get_parallel_path(path)
+        # Parallel parts are written into a preallocated file, so its size says nothing
+        # about which ranges are done
+        parallel_path.unlink(missing_ok=True)
+        if not part_path.exists():
+            part_path.touch()
+        progress = RangeProgress(part_path, part_path.stat().st_size)
+        futures = []
+        if progress.position == 0 and self.parallel_parts > 1:
+            # The first response carries the size, so a large file is split once it
+            # arrives instead of being probed up front
+            progress.on_size = lambda size: futures.extend(
+                self.split(urls, progress, parallel_path, size)
+            )
+        start_time = time.perf_counter()
+        try:
+            self.download_range(urls, progress)
+            downloaded = progress.received + sum(future.result() for future in futures)
+        except Exception:
+            for future in futures:
+                future.cancel()
+            if futures:
+                parallel_path.unlink(missing_ok=True)
+            raise
+        if futures:
+            os.replace(parallel_path, part_path)
+        elapsed = time.perf_counter() - start_time
+        self._add_stats(downloaded, elapsed)
+        os.replace(part_path, path)
+        logger.debug(
+            f'Downloaded {downloaded / 1024 / 1024:.2f} MiB to "{path}" '
+            f"at {downloaded / max(elapsed, 1e-6) / 1024 / 1024:.2f} MiB/s"
+        )
+        return downloaded
+
+    def split(
+        self,
+        urls: list[str],
+        progress: RangeProgress,
+        parallel_path: Path,
+        size: int,
+    ) -> list[Future]:
+        if size < self.parallel_threshold:
+            return []
+        with parallel_path.open("wb") as file:
+            file.truncate(size)
+        part_size = -(-size // self.parallel_parts)
+        # The response that reported the size goes on to download the first part
+        progress.path = parallel_path
+        progress.end = part_size - 1
+        return [
+            self._executor.submit(
+                self.download_range,
+                urls,
+                RangeProgress(parallel_path, start, min(start + part_size, size) - 1),
+            )
+            for start in range(part_size, size, part_size)
+        ]
+
+    def download_range(self, urls: str | list[str], progress: RangeProgress) -> int:
+        urls = self.get_ordered_urls(urls)
+        start = progress.position
+        for url_index, url in enumerate(urls):
+            has_fallback = url_index + 1 < len(urls)
+            transfer_start = progress.received
+            start_time = time.perf_counter()
+            try:
+                self.transfer(url, progress, has_fallback)
+            except Exception as e:
+                self.record_transfer(
+                    url,
+                    progress.received - transfer_start,
+                    time.perf_counter() - start_time,
+                    True,
+                )
+                if not has_fallback:
+                    raise
+                logger.debug(
+                    f"Failing over from {self.get_host(url)} at byte {progress.position}: {e}"
+                )
+                if self.metrics is not None:
+                    self.metrics.increment("cdn_failovers")
+                continue
+            self.record_transfer(
+                url,
+                progress.received - transfer_start,
+                time.perf_counter() - start_time,
+                False,
+            )
+            break
+        if progress.end is not None and progress.position != progress.end + 1:
+            raise Exception(
+                f"Incomplete range: got {progress.position - start} "
+                f"of {progress.end - start + 1} bytes"
+            )
+        return progress.received
+
+    def transfer(
+        self,
+        url: str,
+        progress: RangeProgress,
+        has_fallback: bool = False,
+    ):
+        position = progress.position
+        headers = {}
+        if position or progress.end is not None:
+            end = progress.end if progress.end is not None else ""
+            headers["Range"] = f"bytes={position}-{end}"
+        elif progress.on_size is not None:
+            # Only a ranged response shows that the CDN can serve the file in parts
+            headers["Range"] = "bytes=0-"
+        session = self.failover_session if has_fallback else self.session
+        with self.bandwidth_scheduler.slot(url), session.get(
+            url,
+            headers=headers,
+            stream=True,
+            timeout=self.timeout,
+        ) as response:
+            if response.status_code != 416 or progress.end is not None:
+                self.write_response(response, progress, has_fallback)
+                return
+            unsatisfied_range = re.fullmatch(
+                self.UNSATISFIED_RANGE_REGEX,
+                response.headers.get("Content-Range", ""),
+            )
+        # Only a .part that already holds the whole file is complete
+        if unsatisfied_range is not None and int(unsatisfied_range.group(1)) == position:
+            return
+        logger.debug(
+            f'"{progress.path}" doesn\'t match the size on {self.get_host(url)}, restarting'
+        )
+        progress.position = 0
+        with progress.path.open("r+b") as file:
+            file.truncate(0)
+        self.transfer(url, progress, has_fallback)
+
+    def write_response(
+        self,
+        response: requests.Response,
+        progress: RangeProgress,
+        has_fallback: bool,
+    ):
+        response.raise_for_status()
+        if "Range" in response.request.headers and response.status_code != 206:
+            if progress.end is not None:
+                raise Exception(
+                    f"Range request not honored for bytes {progress.position}-{progress.end}"
+                )
+            progress.position = 0
+        if progress.on_size is not None:
+            content_range = re.fullmatch(
+                self.CONTENT_RANGE_REGEX,
+                response.headers.get("Content-Range", ""),
+            )
+            on_size = progress.on_size
+            progress.on_size = None
+            if response.status_code == 206 and content_range is not None:
+                on_size(int(content_range.group(3)))
+        with progress.path.open("r+b") as file:
+            if progress.end is None:
+                file.truncate(progress.position)
+            file.seek(progress.position)
+            window_start = time.perf_counter()
+            window_bytes = 0
+            window_waited = 0.0
+            for chunk in response.iter_content(chunk_size=self.chunk_size):
+                # A response that was split after it started only fills the first part
+                if progress.end is not None:
+                    chunk = chunk[: progress.end + 1 - progress.position]
+                file.write(chunk)
+                progress.position += len(chunk)
+                progress.received += len(chunk)
+                window_bytes += len(chunk)
+                window_waited += self.bandwidth_scheduler.consume(len(chunk))
+                if progress.end is not None and progress.position > progress.end:
+                    break
+                # Time spent throttled by the bandwidth cap doesn't count against the host
+                window_seconds = time.perf_counter() - window_start - window_waited
+                if window_seconds < self.throughput_window:
+                    continue
+                if has_fallback and window_bytes / window_seconds < self.min_throughput:
+                    raise Exception(
+                        f"Throughput dropped to "
+                        f"{window_bytes / window_seconds / 1024:.0f} KiB/s"
+                    )
+                window_start = time.perf_counter()
+                window_bytes = 0
+                window_waited = 0.0
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+        self.session.close()
+        self.failover_session.close()
@@ -0,0 +1,96 @@
+from __future__ import annotations
+
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+
+class JobJournal:
+    STAGES = ("metadata", "downloaded", "remuxed", "tagged", "complete")
+
+    def __init__(self, path: Path | str = ":memory:"):
+        self.path = path
+        self._lock = threading.Lock()
+        self._setup_database()
+
+    def _setup_database(self):
+        if self.path != ":memory:":
+            Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        self.connection = sqlite3.connect(str(self.path), check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS jobs (
+                track_id TEXT PRIMARY KEY,
+                file_id TEXT,
+                decryption_key TEXT,
+                stage TEXT NOT NULL,
+                updated_at REAL NOT NULL
+            )
+            """
+        )
+        self.connection.commit()
+
+    @classmethod
+    def has_reached(cls, stage: str | None, target_stage: str) -> bool:
+        if stage is None:
+            return False
+        return cls.STAGES.index(stage) >= cls.STAGES.index(target_stage)
+
+    def get(self, track_id: str) -> dict | None:
+        with self._lock:
+            row = self.connection.execute(
+                "SELECT file_id, decryption_key, stage FROM jobs WHERE track_id = ?",
+                (track_id,),
+            ).fetchone()
+        if row is None:
+            return None
+        return {"file_id": row[0], "decryption_key": row[1], "stage": row[2]}
+
+    def set_stage(
+        self,
+        track_id: str,
+        stage: str,
+        file_id: str = None,
+        decryption_key: str = None,
+    ):
+        with self._lock:
+            self.connection.execute(
+                """
+                INSERT INTO jobs VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (track_id) DO UPDATE SET
+                    file_id = COALESCE(excluded.file_id, file_id),
+                    decryption_key = COALESCE(excluded.decryption_key, decryption_key),
+                    stage = excluded.stage,
+                    updated_at = excluded.updated_at
+                """,
+                (track_id, file_id, decryption_key, stage, time.time()),
+            )
+            self.connection.commit()
+
+    def discard(self, track_id: str):
+        with self._lock:
+            self.connection.execute("DELETE FROM jobs WHERE track_id = ?", (track_id,))
+            self.connection.commit()
+
+    def collect_garbage(self, temp_path: Path) -> int:
+        with self._lock:
+            track_ids = [
+                row[0]
+                for row in self.connection.execute(
+                    "SELECT track_id FROM jobs WHERE stage = 'complete'"
+                )
+            ]
+        removed = 0
+        for track_id in track_ids:
+            if temp_path.exists():
+                for leftover_path in temp_path.glob(f"{track_id}_*"):
+                    leftover_path.unlink(missing_ok=True)
+                    removed += 1
+            self.discard(track_id)
+        return removed
+
+    def close(self):
+        with self._lock:
+            self.connection.close()
@@ -0,0 +1,180 @@
+from __future__ import annotations
+
+import json
+import logging
+import os
+import re
+import threading
+from pathlib import Path
+from typing import Iterator
+
+logger = logging.getLogger(__name__)
+
+
+class LibraryIndex:
+    FILE_NAME = ".library.json"
+    ISRC_TAG = "----:com.apple.iTunes:ISRC"
+    TRACK_URL_REGEX = r"open\.spotify\.com/track/(\w{22})"
+
+    def __init__(self, music_root: Path = Path("."), path: Path = None):
+        self.music_root = music_root
+        self.path = path if path is not None else music_root / self.FILE_NAME
+        self.entries = {}
+        self.track_ids = {}
+        self.isrcs = {}
+        self._lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        if not self.path.exists():
+            return
+        self.entries = json.loads(self.path.read_text(encoding="utf8"))
+        for relative_path, entry in self.entries.items():
+            self._add_lookups(relative_path, entry)
+
+    def save(self):
+        with self._lock:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            temp_path = self.path.with_suffix(".tmp")
+            temp_path.write_text(json.dumps(self.entries), encoding="utf8")
+            os.replace(temp_path, self.path)
+
+    def _add_lookups(self, relative_path: str, entry: dict):
+        if entry["track_id"] is not None:
+            self.track_ids.setdefault(entry["track_id"], []).append(relative_path)
+        if entry["isrc"] is not None:
+            self.isrcs.setdefault(entry["isrc"], []).append(relative_path)
+
+    def _remove_lookups(self, relative_path: str, entry: dict):
+        for lookup, key in (
+            (self.track_ids, entry["track_id"]),
+            (self.isrcs, entry["isrc"]),
+        ):
+            relative_paths = lookup.get(key)
+            if relative_paths is None:
+                continue
+            if relative_path in relative_paths:
+                relative_paths.remove(relative_path)
+            if not relative_paths:
+                del lookup[key]
+
+    def _set_entry(self, relative_path: str, entry: dict):
+        with self._lock:
+            previous_entry = self.entries.get(relative_path)
+            if previous_entry is not None:
+                self._remove_lookups(relative_path, previous_entry)
+            self.entries[relative_path] = entry
+            self._add_lookups(relative_path, entry)
+
+    def get_relative_path(self, path: Path) -> str | None:
+        try:
+            return path.relative_to(self.music_root).as_posix()
+        except ValueError:
+            return None
+
+    def read_tags(self, path: Path) -> tuple[str | None, str | None]:
+        from mutagen.mp4 import MP4
+
+        try:
+            tags = MP4(path).tags or {}
+        except Exception as e:
+            logger.debug(f'Failed to read tags of "{path}": {e}')
+            return None, None
+        track_id = None
+        for url in tags.get("\xa9url", []):
+            match = re.search(self.TRACK_URL_REGEX, url)
+            if match is not None:
+                track_id = match.group(1)
+                break
+        isrc = tags.get(self.ISRC_TAG)
+        isrc = bytes(isrc[0]).decode("utf8", "replace") if isrc else None
+        return track_id, isrc
+
+    def iter_files(self) -> Iterator[Path]:
+        for root, dirs, files in os.walk(self.music_root):
+            dirs[:] = [i for i in dirs if not i.startswith(".")]
+            for file_name in files:
+                if file_name.endswith(".m4a") and not file_name.startswith("."):
+                    yield Path(root) / file_name
+
+    def scan(self) -> int:
+        seen_paths = set()
+        read_files = 0
+        for path in self.iter_files():
+            relative_path = self.get_relative_path(path)
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            seen_paths.add(relative_path)
+            entry = self.entries.get(relative_path)
+            if (
+                entry is not None
+                and entry["mtime"] == stat.st_mtime_ns
+                and entry["size"] == stat.st_size
+            ):
+                continue
+            track_id, isrc = self.read_tags(path)
+            read_files += 1
+            self._set_entry(
+                relative_path,
+                {
+                    "mtime": stat.st_mtime_ns,
+                    "size": stat.st_size,
+                    "track_id": track_id,
+                    "isrc": isrc,
+                },
+            )
+        with self._lock:
+            removed_paths = [i for i in self.entries if i not in seen_paths]
+            for relative_path in removed_paths:
+                self._remove_lookups(relative_path, self.entries.pop(relative_path))
+        logger.debug(
+            f"Library scan: {len(seen_paths)} files, {read_files} read, "
+            f"{len(removed_paths)} removed"
+        )
+        return read_files
+
+    def add(self, path: Path, track_id: str, isrc: str = None):
+        relative_path = self.get_relative_path(path)
+        if relative_path is None:
+            return
+        stat = path.stat()
+        self._set_entry(
+            relative_path,
+            {
+                "mtime": stat.st_mtime_ns,
+                "size": stat.st_size,
+                "track_id": track_id,
+                "isrc": isrc,
+            },
+        )
+
+    def remove(self, path: Path):
+        relative_path = self.get_relative_path(path)
+        with self._lock:
+            entry = self.entries.pop(relative_path, None)
+            if entry is not None:
+                self._remove_lookups(relative_path, entry)
+
+    def has_path(self, path: Path) -> bool:
+        with self._lock:
+            return self.get_relative_path(path) in self.entries
+
+    def get(
+        self,
+        track_id: str,
+        isrc: str = None,
+        folder_path: Path = None,
+    ) -> Path | None:
+        with self._lock:
+            relative_paths = list(self.track_ids.get(track_id, ()))
+            if isrc is not None:
+                relative_paths.extend(self.isrcs.get(isrc, ()))
+        for relative_path in relative_paths:
+            path = self.music_root / relative_path
+            if folder_path is not None and path.parent != folder_path:
+                continue
+            if path.exists():
+                return path
+        return None
@@ -1,37 +1,82 @@
 from __future__ import annotations
 
-import inspect
-import json
 import logging
-import os
+import re
 from enum import Enum
 from pathlib import Path
 import subprocess
-import shutil
 
 import click
 
-MP4_TAGS_MAP = {
-    "album": "\xa9alb",
-    "album_artist": "aART",
-    "artist": "\xa9ART",
-    "composer": "\xa9wrt",
-    "copyright": "cprt",
-    "media_type": "stik",
-    "producer": "\xa9prd",
-    "release_date": "\xa9day",
-    "title": "\xa9nam",
-    "url": "\xa9url",
-}
-
-from .downloader import Downloader
-from .downloader_song import DownloaderSong
-from .enums import DownloadModeSong, RemuxMode
-from .spotify_api import SpotifyApi
-
-spotify_api_sig = inspect.signature(SpotifyApi.__init__)
-downloader_sig = inspect.signature(Downloader.__init__)
-downloader_song_sig = inspect.signature(DownloaderSong.__init__)
+from .enums import DownloadModeSong, LinkMode
+from .models import BandwidthWindow
+
+RATE_REGEX = r"(\d+(?:\.\d+)?)([KMG]?)"
+RATE_UNITS = {"": 1, "K": 1024, "M": 1024**2, "G": 1024**3}
+BANDWIDTH_WINDOW_REGEX = r"(\d{1,2}):(\d{2})-(\d{1,2}):(\d{2})=(.+)"
+
+
+def get_batch_entries(
+    urls: tuple[str],
+    foldername: str | None,
+    url_file: Path | None,
+) -> list[tuple[str, str]]:
+    entries = [(i, foldername) for i in urls]
+    if url_file is not None:
+        for line in url_file.read_text(encoding="utf8").splitlines():
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            url, _, line_foldername = line.partition(" ")
+            entries.append((url, line_foldername.strip() or foldername))
+    if not entries:
+        raise click.UsageError("No URL given")
+    if any(i[1] is None for i in entries):
+        raise click.UsageError("Missing --foldername for URLs without a folder name")
+    return list(dict.fromkeys(entries))
+
+
+def get_rate(value: str) -> float | None:
+    match = re.fullmatch(RATE_REGEX, value.strip().upper())
+    if match is None:
+        raise click.BadParameter(f"Invalid rate: {value} (expected e.g. 500K or 2M)")
+    rate = float(match.group(1)) * RATE_UNITS[match.group(2)]
+    # A rate of 0 means unlimited
+    return rate or None
+
+
+def parse_bandwidth_limit(
+    ctx: click.Context,
+    param: click.Parameter,
+    value: str | None,
+) -> float | None:
+    return get_rate(value) if value is not None else None
+
+
+def parse_bandwidth_windows(
+    ctx: click.Context,
+    param: click.Parameter,
+    value: tuple[str],
+) -> list[BandwidthWindow]:
+    windows = []
+    for window in value:
+        match = re.fullmatch(BANDWIDTH_WINDOW_REGEX, window.strip())
+        if match is None:
+            raise click.BadParameter(
+                f"Invalid window: {window} (expected e.g. 01:00-06:00=0)"
+            )
+        start_hour, start_minute, end_hour, end_minute = map(int, match.groups()[:4])
+        if max(start_hour, end_hour) > 24 or max(start_minute, end_minute) > 59:
+            raise click.BadParameter(f"Invalid time in window: {window}")
+        windows.append(
+            BandwidthWindow(
+                start=start_hour * 60 + start_minute,
+                end=end_hour * 60 + end_minute,
+                rate=get_rate(match.group(5)),
+            )
+        )
+    return windows
+
 
 def get_param_string(param: click.Parameter) -> str:
     if isinstance(param.default, Enum):
@@ -41,6 +86,12 @@ def get_param_string(param: click.Parameter) -> str:
     else:
         return param.default
 
+def update_mpd_database(logger: logging.Logger):
+    # Update mpc/mpd database (OPTIONAL)
+    subprocess.run('mpc update', shell = True)
+    logger.info("Updated mpc database")
+
+
 @click.command()
 @click.help_option("-h", "--help")
 
@@ -49,14 +100,41 @@ def get_param_string(param: click.Parameter) -> str:
     "url",
     nargs=-1,
     type=str,
-    required=True,
 )
 @click.option(
     "--foldername",
     "-f",
     type=str,  # Remove is_flag=True to allow passing a folder name
-    required=True,
-    help="The name of the output folder (within ~/Music)",
+    help="The name of the output folder (within the music root)",
+)
+@click.option(
+    "--music-root",
+    type=click.Path(path_type=Path, file_okay=False),
+    default=Path.home() / "Music",
+    show_default=True,
+    help="Directory the playlist folders are created in",
+)
+@click.option(
+    "--store-path",
+    type=click.Path(path_type=Path, file_okay=False),
+    help="Directory of the deduplicated audio store [default: <music root>/.store]",
+)
+@click.option(
+    "--library-path",
+    type=click.Path(path_type=Path, dir_okay=False),
+    help="Index of the tracks already in the music root [default: <music root>/.library.json]",
+)
+@click.option(
+    "--link-mode",
+    type=click.Choice([i.value for i in LinkMode]),
+    default=LinkMode.AUTO.value,
+    show_default=True,
+    help="How playlist folders are populated from the store",
+)
+@click.option(
+    "--url-file",
+    type=click.Path(path_type=Path, exists=True, dir_okay=False),
+    help="File listing one URL per line, optionally followed by its own folder name",
 )
 @click.option(
     "--premium",
@@ -65,12 +143,189 @@ def get_param_string(param: click.Parameter) -> str:
     type=bool,
     help="Whether to download music in premium quality (requires a Spotify Premium account)",
 )
+@click.option(
+    "--download-mode",
+    type=click.Choice([i.value for i in DownloadModeSong]),
+    default=DownloadModeSong.YTDLP.value,
+    show_default=True,
+    help="Backend used to download tracks",
+)
+@click.option(
+    "--stream",
+    is_flag=True,
+    help="Pipe downloads straight into ffmpeg instead of writing an encrypted temporary file",
+)
+@click.option(
+    "--bandwidth-limit",
+    type=str,
+    callback=parse_bandwidth_limit,
+    help="Cap the combined download speed in bytes/sec, e.g. 500K or 2M (0 for unlimited)",
+)
+@click.option(
+    "--bandwidth-window",
+    "bandwidth_windows",
+    type=str,
+    multiple=True,
+    callback=parse_bandwidth_windows,
+    help="Use another cap between two local times, e.g. 01:00-06:00=0 (can be repeated)",
+)
+@click.option(
+    "--max-host-connections",
+    type=click.IntRange(min=1),
+    help="Maximum number of simultaneous downloads from one CDN host [default: unlimited]",
+)
+@click.option(
+    "--metadata-workers",
+    type=click.IntRange(min=1),
+    default=4,
+    show_default=True,
+    help="Number of workers fetching metadata, keys and stream URLs",
+)
+@click.option(
+    "--download-workers",
+    type=click.IntRange(min=1),
+    default=4,
+    show_default=True,
+    help="Number of workers downloading tracks",
+)
+@click.option(
+    "--remux-workers",
+    type=click.IntRange(min=1),
+    help="Number of concurrent remux processes [default: number of CPUs]",
+)
+@click.option(
+    "--remux-timeout",
+    type=click.FloatRange(min=1),
+    default=300,
+    show_default=True,
+    help="Seconds after which a remux process is killed",
+)
+@click.option(
+    "--tag-workers",
+    type=click.IntRange(min=1),
+    default=2,
+    show_default=True,
+    help="Number of workers tagging and moving tracks",
+)
+@click.option(
+    "--lyrics",
+    is_flag=True,
+    help="Embed lyrics and save synced lyrics as .lrc files next to the tracks",
+)
+@click.option(
+    "--lyrics-workers",
+    type=click.IntRange(min=1),
+    default=2,
+    show_default=True,
+    help="Number of workers getting lyrics in the background",
+)
+@click.option(
+    "--queue-size",
+    type=click.IntRange(min=1),
+    default=8,
+    show_default=True,
+    help="Maximum number of tracks waiting between two pipeline stages",
+)
+@click.option(
+    "--cache-path",
+    type=click.Path(path_type=Path, dir_okay=False),
+    default=Path("./cache.db"),
+    show_default=True,
+    help="Path to the persistent metadata cache",
+)
+@click.option(
+    "--cover-cache-path",
+    type=click.Path(path_type=Path, file_okay=False),
+    default=Path("./cover_cache"),
+    show_default=True,
+    help="Directory of the cover art cache",
+)
+@click.option(
+    "--journal-path",
+    type=click.Path(path_type=Path, dir_okay=False),
+    default=Path("./journal.db"),
+    show_default=True,
+    help="Path to the job journal used to resume interrupted downloads",
+)
+@click.option(
+    "--pagination-concurrency",
+    type=click.IntRange(min=1),
+    default=4,
+    show_default=True,
+    help="Number of playlist/album pages requested at the same time",
+)
+@click.option(
+    "--report-path",
+    type=click.Path(path_type=Path, dir_okay=False),
+    help="Write a JSON run report here (appended as one line if it ends in .ndjson)",
+)
+@click.option(
+    "--prometheus-path",
+    type=click.Path(path_type=Path, dir_okay=False),
+    help="Write run metrics here in the Prometheus textfile format",
+)
+@click.option(
+    "--watch",
+    is_flag=True,
+    help="Keep running and sync sources whenever their playlist snapshot changes",
+)
+@click.option(
+    "--watch-interval",
+    type=click.FloatRange(min=10),
+    default=300,
+    show_default=True,
+    help="Seconds between playlist snapshot polls in watch mode",
+)
+@click.option(
+    "--status-port",
+    type=click.IntRange(min=0, max=65535),
+    help="Serve the watch mode status on this local port (GET /status, POST /sync, POST /stop)",
+)
+@click.option(
+    "--force",
+    is_flag=True,
+    help="Sync the playlist even if its snapshot hasn't changed since the last sync",
+)
+@click.option(
+    "--prune",
+    is_flag=True,
+    help="Delete tracks that were removed from the playlist",
+)
 
 
 def main(
-    url: str,
+    url: tuple[str],
     foldername: str,
+    music_root: Path,
+    store_path: Path,
+    library_path: Path,
+    link_mode: str,
+    url_file: Path,
     premium: bool,
+    download_mode: str,
+    stream: bool,
+    bandwidth_limit: float | None,
+    bandwidth_windows: list[BandwidthWindow],
+    max_host_connections: int | None,
+    metadata_workers: int,
+    download_workers: int,
+    remux_workers: int,
+    remux_timeout: float,
+    tag_workers: int,
+    lyrics: bool,
+    lyrics_workers: int,
+    queue_size: int,
+    cache_path: Path,
+    cover_cache_path: Path,
+    journal_path: Path,
+    pagination_concurrency: int,
+    report_path: Path,
+    prometheus_path: Path,
+    watch: bool,
+    watch_interval: float,
+    status_port: int,
+    force: bool,
+    prune: bool,
     cookies_path = Path("./cookies.txt"),
     temp_path: Path = Path("./temp"),
 ) -> None:
@@ -78,107 +333,89 @@ def main(
         format="[%(levelname)-8s %(asctime)s] %(message)s",
         datefmt="%H:%M:%S",
     )
-    logger = logging.getLogger(__name__)
+    logger = logging.getLogger(__package__)
     logger.setLevel(2)
+    batch_entries = get_batch_entries(url, foldername, url_file)
+    # Heavy imports are deferred so that --help and usage errors stay fast
+    from .cache import ImageCache, MetadataCache
+    from .downloader import Downloader
+    from .downloader_song import DownloaderSong
+    from .library import LibraryIndex
+    from .metrics import RunMetrics
+    from .process_executor import ProcessExecutor
+    from .ratelimit import BandwidthScheduler
+    from .retry_session import RetrySession
+    from .spotify_api import SpotifyApi
+    from .store import AudioStore
+    from .syncer import Syncer
+    from .watcher import Watcher
+
     if not cookies_path.exists():
-        logger.critical("Cookies file not found: ", cookies_path)
+        logger.critical(f"Cookies file not found: {cookies_path}")
         return
-    spotify_api = SpotifyApi(cookies_path)
+    metrics = RunMetrics()
+    spotify_api = SpotifyApi(
+        cookies_path,
+        MetadataCache(cache_path),
+        pagination_concurrency=pagination_concurrency,
+        metrics=metrics,
+    )
     downloader = Downloader(
         spotify_api,
-        foldername
+        temp_path,
+        image_cache=ImageCache(
+            cover_cache_path,
+            session=RetrySession(metrics=metrics),
+        ),
+        process_executor=ProcessExecutor(remux_workers, remux_timeout, metrics),
     )
     downloader_song = DownloaderSong(
         downloader,
-        premium
+        download_mode=DownloadModeSong(download_mode),
+        premium=premium,
+        stream=stream,
+        bandwidth_scheduler=BandwidthScheduler(
+            bandwidth_limit,
+            bandwidth_windows,
+            max_host_connections,
+        ),
+    )
+    store = AudioStore(
+        store_path if store_path is not None else music_root / ".store",
+        LinkMode(link_mode),
+    )
+    syncer = Syncer(
+        downloader_song,
+        music_root,
+        store,
+        library=LibraryIndex(music_root, library_path),
+        journal_path=journal_path,
+        metadata_workers=metadata_workers,
+        download_workers=download_workers,
+        remux_workers=remux_workers,
+        tag_workers=tag_workers,
+        queue_size=queue_size,
+        lyrics=lyrics,
+        lyrics_workers=lyrics_workers,
+        force=force,
+        prune=prune,
+        report_path=report_path,
+        prometheus_path=prometheus_path,
     )
-    logger.debug("Setting up CDM")
-    downloader.set_cdm()
-    logger.debug("Queuing songs...")
-    try:
-        global song_queue
-        url_info = downloader.get_url_info(url[0])
-        song_queue = downloader.get_download_queue(url_info)
-    except Exception as e:
-        logger.error(f'Failed to get {url[0]} Error: {e}')
-        exit()
     try:
-        # Create the folder if it doesn't exist
-        folder_path = Path(f"/home/alec/Music/{foldername}/")
-        os.makedirs(folder_path, exist_ok=True)
-        
-        for queue_index, queue_item in enumerate(song_queue, start=1):
-            track = queue_item.metadata
-
-            # First, check if the file already exists
-            final_path = folder_path.joinpath(f"{track['album']['artists'][0]['name']} - {track['name']}.m4a")
-
-            if final_path.exists():
-                logger.info(f"(Skipping {queue_index}/{len(song_queue)}) {track['album']['artists'][0]['name']} - {track['name']} already exists")
-                continue
-
-            # Download the song if it doesn't exist
-            queue_progress = f"Downloading track {queue_index}/{len(song_queue)}"
-            logger.info(f'({queue_progress}) Downloading "{track["name"]}"')
-            track_id = track["id"]
-            logger.debug("Getting GID metadata")
-            gid = spotify_api.track_id_to_gid(track_id)
-            metadata_gid = spotify_api.get_gid_metadata(gid)
-
-            # Get metadata
-            logger.debug("Getting album metadata")
-            album_metadata = spotify_api.get_album(
-                spotify_api.gid_to_track_id(metadata_gid["album"]["gid"])
-            )
-
-            # Get creds
-            logger.debug("Getting track credits")
-            track_credits = spotify_api.get_track_credits(track_id)
-            tags = downloader_song.get_tags(
-                metadata_gid,
-                album_metadata,
-                track_credits,
-            )
-
-            logger.debug("Getting file info")
-            file_id = downloader_song.get_file_id(metadata_gid)
-            if not file_id:
-                logger.error(
-                    f"({queue_progress}) Track not available on Spotify's "
-                    "servers and no alternative found, skipping"
-                )
-                continue
-            
-            logger.debug("Getting PSSH")
-            pssh = spotify_api.get_pssh(file_id)
-            logger.debug("Getting decryption key")
-            decryption_key = downloader_song.get_decryption_key(pssh)
-            logger.debug("Getting stream URL")
-            stream_url = spotify_api.get_stream_url(file_id)
-            encrypted_path = temp_path.joinpath(f"{track_id}_encrypted.m4a")
-            decrypted_path = temp_path.joinpath(f"{track_id}_decrypted.m4a")
-            logger.debug(f'Downloading to "{encrypted_path}"')
-            downloader_song.download(encrypted_path, stream_url)
-            remuxed_path = temp_path.joinpath(f"{track_id}_remuxed.m4a")
-            logger.debug(f'Decrypting/Remuxing to "{remuxed_path}"')
-            downloader_song.remux(
-                encrypted_path,
-                decrypted_path,
-                remuxed_path,
-                decryption_key,
-            )
-
-            logger.debug("Applying tags")
-            downloader.apply_tags(remuxed_path, tags)
-            logger.debug(f'Moving to "{final_path}"')
-            downloader.move_to_final_path(remuxed_path, final_path)
-    except Exception as e:
-        logger.error(f'Failed to download song! Error: {e}')
-    finally: # Clean up
-        if temp_path.exists():
-            shutil.rmtree(temp_path)
-    logger.info("Completed playlist download")
-
-    # Update mpc/mpd database (OPTIONAL)
-    subprocess.run('mpc update', shell = True)
-    logger.info("Updated mpc database")
\ No newline at end of file
+        if watch:
+            Watcher(
+                syncer,
+                batch_entries,
+                interval=watch_interval,
+                status_port=status_port,
+                on_sync=lambda _: update_mpd_database(logger),
+            ).run()
+        else:
+            result = syncer.sync(batch_entries)
+    finally:
+        downloader_song.http_downloader.close()
+        spotify_api.cache.close()
+    if watch or not result.sources:
+        return
+    update_mpd_database(logger)
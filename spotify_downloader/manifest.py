@@ -0,0 +1,155 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import threading
+from pathlib import Path
+from typing import Iterable, Iterator
+
+from .models import DownloadQueueItem, ManifestDiff
+
+
+class SyncManifest:
+    FILE_NAME = ".spotify-downloader.json"
+
+    def __init__(self, folder_path: Path):
+        self.folder_path = folder_path
+        self.path = folder_path / self.FILE_NAME
+        self.snapshots = {}
+        self.tracks = {}
+        self._lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        if not self.path.exists():
+            return
+        manifest = json.loads(self.path.read_text(encoding="utf8"))
+        self.snapshots = manifest.get("snapshots", {})
+        self.tracks = manifest.get("tracks", {})
+
+    def save(self):
+        with self._lock:
+            manifest = {
+                "snapshots": self.snapshots,
+                "tracks": self.tracks,
+            }
+            temp_path = self.path.with_suffix(".tmp")
+            temp_path.write_text(json.dumps(manifest, indent=1), encoding="utf8")
+            os.replace(temp_path, self.path)
+
+    @staticmethod
+    def get_metadata_hash(track: DownloadQueueItem) -> str:
+        metadata = [
+            track.name,
+            list(track.artists),
+            track.album_id,
+            track.album_name,
+            track.album_artist,
+        ]
+        return hashlib.sha1(
+            json.dumps(metadata, ensure_ascii=False).encode("utf8")
+        ).hexdigest()
+
+    @staticmethod
+    def get_content_hash(path: Path) -> str:
+        content_hash = hashlib.sha256()
+        with path.open("rb") as file:
+            for chunk in iter(lambda: file.read(1024 * 1024), b""):
+                content_hash.update(chunk)
+        return content_hash.hexdigest()
+
+    def get_track_path(self, track_id: str) -> Path | None:
+        entry = self.tracks.get(track_id)
+        if entry is None:
+            return None
+        return self.folder_path / entry["path"]
+
+    def is_unchanged(self, source_id: str, snapshot_id: str | None) -> bool:
+        if snapshot_id is None or self.snapshots.get(source_id) != snapshot_id:
+            return False
+        return all(
+            self.get_track_path(track_id).exists()
+            for track_id, entry in self.tracks.items()
+            if source_id in entry["sources"]
+        )
+
+    def set_snapshot(self, source_id: str, snapshot_id: str | None):
+        with self._lock:
+            if snapshot_id is None:
+                self.snapshots.pop(source_id, None)
+            else:
+                self.snapshots[source_id] = snapshot_id
+
+    def iter_diff(
+        self,
+        source_id: str,
+        queue_pages: Iterable[list[DownloadQueueItem]],
+        diff: ManifestDiff,
+    ) -> Iterator[list[DownloadQueueItem]]:
+        queued_ids = set()
+        for queue_page in queue_pages:
+            changes = []
+            for queue_item in queue_page:
+                track_id = queue_item.id
+                queued_ids.add(track_id)
+                entry = self.tracks.get(track_id)
+                if entry is None or not self.get_track_path(track_id).exists():
+                    diff.added.append(queue_item)
+                    changes.append(queue_item)
+                elif entry["metadata_hash"] != self.get_metadata_hash(queue_item):
+                    diff.changed.append(queue_item)
+                    changes.append(queue_item)
+                elif source_id not in entry["sources"]:
+                    with self._lock:
+                        entry["sources"].append(source_id)
+            yield changes
+        with self._lock:
+            diff.removed = [
+                track_id
+                for track_id, entry in self.tracks.items()
+                if source_id in entry["sources"] and track_id not in queued_ids
+            ]
+
+    def get_diff(
+        self,
+        source_id: str,
+        download_queue: list[DownloadQueueItem],
+    ) -> ManifestDiff:
+        diff = ManifestDiff()
+        for _ in self.iter_diff(source_id, [download_queue], diff):
+            pass
+        return diff
+
+    def add_track(
+        self,
+        source_id: str,
+        track: DownloadQueueItem,
+        final_path: Path,
+        content_hash: str = None,
+    ):
+        if content_hash is None:
+            content_hash = self.get_content_hash(final_path)
+        with self._lock:
+            entry = self.tracks.get(track.id)
+            sources = entry["sources"] if entry is not None else []
+            if source_id not in sources:
+                sources.append(source_id)
+            self.tracks[track.id] = {
+                "path": final_path.relative_to(self.folder_path).as_posix(),
+                "hash": content_hash,
+                "metadata_hash": self.get_metadata_hash(track),
+                "sources": sources,
+            }
+
+    def remove_source(self, source_id: str, track_id: str) -> Path | None:
+        with self._lock:
+            entry = self.tracks.get(track_id)
+            if entry is None:
+                return None
+            if source_id in entry["sources"]:
+                entry["sources"].remove(source_id)
+            if entry["sources"]:
+                return None
+            del self.tracks[track_id]
+        return self.folder_path / entry["path"]
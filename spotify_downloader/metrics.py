@@ -0,0 +1,186 @@
+from __future__ import annotations
+
+import collections
+import contextlib
+import json
+import math
+import os
+import re
+import threading
+import time
+import urllib.parse
+from pathlib import Path
+from typing import Iterator
+
+import requests
+
+
+class RunMetrics:
+    ID_SEGMENT_REGEX = r"[0-9A-Za-z]{16,}"
+    PROMETHEUS_PREFIX = "spotify_downloader"
+
+    def __init__(self):
+        self.started_at = time.time()
+        self.timings = collections.defaultdict(list)
+        self.bytes = collections.Counter()
+        self.requests = collections.Counter()
+        self.request_bytes = collections.Counter()
+        self.counters = collections.Counter()
+        self._lock = threading.Lock()
+
+    def reset(self):
+        with self._lock:
+            self.started_at = time.time()
+            self.timings.clear()
+            self.bytes.clear()
+            self.requests.clear()
+            self.request_bytes.clear()
+            self.counters.clear()
+
+    def record(self, stage: str, seconds: float):
+        with self._lock:
+            self.timings[stage].append(seconds)
+
+    @contextlib.contextmanager
+    def time(self, stage: str) -> Iterator[None]:
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - start_time)
+
+    def add_bytes(self, name: str, count: int):
+        with self._lock:
+            self.bytes[name] += count
+
+    def increment(self, name: str, count: int = 1):
+        with self._lock:
+            self.counters[name] += count
+
+    def get_endpoint(self, url: str) -> str:
+        split_url = urllib.parse.urlsplit(url)
+        path = "/".join(
+            "{id}" if re.fullmatch(self.ID_SEGMENT_REGEX, segment) else segment
+            for segment in split_url.path.split("/")
+        )
+        return f"{split_url.hostname}{path}"
+
+    def on_response(self, response: requests.Response, *args, **kwargs):
+        self.add_request(str(response.url), response.headers.get("Content-Length"))
+
+    def add_request(self, url: str, content_length: str = None):
+        endpoint = self.get_endpoint(url)
+        with self._lock:
+            self.requests[endpoint] += 1
+            if content_length is not None and content_length.isdigit():
+                self.request_bytes[endpoint] += int(content_length)
+
+    @staticmethod
+    def get_percentile(sorted_values: list[float], percentile: float) -> float:
+        index = max(math.ceil(percentile / 100 * len(sorted_values)) - 1, 0)
+        return sorted_values[index]
+
+    def get_stage_summary(self) -> dict:
+        with self._lock:
+            timings = {stage: sorted(values) for stage, values in self.timings.items()}
+        return {
+            stage: {
+                "count": len(values),
+                "total": sum(values),
+                "p50": self.get_percentile(values, 50),
+                "p95": self.get_percentile(values, 95),
+                "max": values[-1],
+            }
+            for stage, values in timings.items()
+            if values
+        }
+
+    def get_report(self, extra: dict = None) -> dict:
+        with self._lock:
+            report = {
+                "started_at": self.started_at,
+                "duration": time.time() - self.started_at,
+                "counters": dict(self.counters),
+                "bytes": dict(self.bytes),
+                "requests": dict(self.requests),
+                "request_bytes": dict(self.request_bytes),
+            }
+        report["stages"] = self.get_stage_summary()
+        report.update(extra or {})
+        return report
+
+    @staticmethod
+    def _write_atomic(path: Path, text: str):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = path.with_name(path.name + ".tmp")
+        temp_path.write_text(text, encoding="utf8")
+        os.replace(temp_path, path)
+
+    def write_report(self, path: Path, extra: dict = None):
+        report = self.get_report(extra)
+        if path.suffix == ".ndjson":
+            with path.open("a", encoding="utf8") as file:
+                file.write(json.dumps(report, default=str) + "\n")
+        else:
+            self._write_atomic(path, json.dumps(report, indent=2, default=str))
+
+    @staticmethod
+    def _escape_label(value: str) -> str:
+        return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+    def get_prometheus_text(self) -> str:
+        prefix = self.PROMETHEUS_PREFIX
+        report = self.get_report()
+        lines = [
+            f"# HELP {prefix}_stage_seconds Time spent per track in each stage",
+            f"# TYPE {prefix}_stage_seconds summary",
+        ]
+        for stage, summary in report["stages"].items():
+            stage = self._escape_label(stage)
+            for quantile, key in (("0.5", "p50"), ("0.95", "p95")):
+                lines.append(
+                    f'{prefix}_stage_seconds{{stage="{stage}",quantile="{quantile}"}} '
+                    f"{summary[key]}"
+                )
+            lines.append(f'{prefix}_stage_seconds_sum{{stage="{stage}"}} {summary["total"]}')
+            lines.append(f'{prefix}_stage_seconds_count{{stage="{stage}"}} {summary["count"]}')
+        lines += [
+            f"# HELP {prefix}_stage_max_seconds Slowest track in each stage",
+            f"# TYPE {prefix}_stage_max_seconds gauge",
+        ]
+        for stage, summary in report["stages"].items():
+            lines.append(
+                f'{prefix}_stage_max_seconds{{stage="{self._escape_label(stage)}"}} {summary["max"]}'
+            )
+        lines += [
+            f"# HELP {prefix}_http_requests_total HTTP requests per endpoint",
+            f"# TYPE {prefix}_http_requests_total counter",
+        ]
+        for endpoint, count in report["requests"].items():
+            lines.append(
+                f'{prefix}_http_requests_total{{endpoint="{self._escape_label(endpoint)}"}} {count}'
+            )
+        lines += [
+            f"# HELP {prefix}_bytes_total Bytes transferred or written",
+            f"# TYPE {prefix}_bytes_total counter",
+        ]
+        for name, count in report["bytes"].items():
+            lines.append(f'{prefix}_bytes_total{{name="{self._escape_label(name)}"}} {count}')
+        lines += [
+            f"# HELP {prefix}_events_total Run events such as downloaded or failed tracks",
+            f"# TYPE {prefix}_events_total counter",
+        ]
+        for name, count in report["counters"].items():
+            lines.append(f'{prefix}_events_total{{name="{self._escape_label(name)}"}} {count}')
+        lines += [
+            f"# HELP {prefix}_run_duration_seconds Wall time of the last run",
+            f"# TYPE {prefix}_run_duration_seconds gauge",
+            f"{prefix}_run_duration_seconds {report['duration']}",
+            f"# HELP {prefix}_last_run_timestamp_seconds Start time of the last run",
+            f"# TYPE {prefix}_last_run_timestamp_seconds gauge",
+            f"{prefix}_last_run_timestamp_seconds {report['started_at']}",
+        ]
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path: Path):
+        self._write_atomic(path, self.get_prometheus_text())
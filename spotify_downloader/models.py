@@ -1,6 +1,13 @@
 from __future__ import annotations
 
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import TYPE_CHECKING, Callable
+
+if TYPE_CHECKING:
+    from concurrent.futures import Future
+
+    from .manifest import SyncManifest
 
 
 @dataclass
@@ -17,7 +24,84 @@ class UrlInfo:
 
 @dataclass
 class DownloadQueueItem:
-    metadata: dict = None
+    __slots__ = (
+        "id",
+        "name",
+        "artists",
+        "album_id",
+        "album_name",
+        "album_artist",
+        "isrc",
+    )
+    id: str
+    name: str
+    artists: tuple[str, ...]
+    album_id: str
+    album_name: str
+    album_artist: str
+    isrc: str
+
+
+@dataclass
+class ManifestDiff:
+    added: list[DownloadQueueItem] = field(default_factory=list)
+    changed: list[DownloadQueueItem] = field(default_factory=list)
+    removed: list[str] = field(default_factory=list)
+
+
+@dataclass
+class SyncSource:
+    url: str = None
+    folder_path: Path = None
+    url_info: UrlInfo = None
+    manifest: SyncManifest = None
+    snapshot_id: str = None
+    diff: ManifestDiff = None
+
+
+@dataclass
+class SongDestination:
+    source: SyncSource = None
+    final_path: Path = None
+
+
+@dataclass
+class SongJob:
+    index: int = None
+    total: int = None
+    track: DownloadQueueItem = None
+    destinations: list[SongDestination] = field(default_factory=list)
+    tags: dict = None
+    file_id: str = None
+    decryption_key: str = None
+    stream_urls: list[str] = None
+    encrypted_path: Path = None
+    decrypted_path: Path = None
+    remuxed_path: Path = None
+    is_remuxed: bool = False
+    stage: str = None
+    lyrics_future: Future = None
+    lyrics: Lyrics = None
+
+    @property
+    def progress(self) -> str:
+        if self.total is None:
+            return f"Downloading track {self.index}"
+        return f"Downloading track {self.index}/{self.total}"
+
+
+@dataclass
+class SongFailure:
+    job: SongJob = None
+    stage: str = None
+    error: str = None
+
+
+@dataclass
+class SyncResult:
+    sources: list[SyncSource] = field(default_factory=list)
+    failures: list[SongFailure] = field(default_factory=list)
+    failed_urls: list[str] = field(default_factory=list)
 
 
 @dataclass
@@ -38,3 +122,48 @@ class VideoStreamInfo:
 class VideoM3U8:
     video: str = None
     audio: str = None
+
+
+@dataclass
+class HostStats:
+    requests: int = 0
+    errors: int = 0
+    bytes: int = 0
+    seconds: float = 0.0
+
+    @property
+    def throughput(self) -> float:
+        return self.bytes / self.seconds if self.seconds else 0.0
+
+    @property
+    def error_rate(self) -> float:
+        return self.errors / self.requests if self.requests else 0.0
+
+
+@dataclass
+class RangeProgress:
+    path: Path
+    position: int
+    end: int = None
+    received: int = 0
+    on_size: Callable[[int], None] = None
+
+
+@dataclass
+class BandwidthWindow:
+    start: int
+    end: int
+    rate: float | None
+
+    def contains(self, minute: int) -> bool:
+        if self.start <= self.end:
+            return self.start <= minute < self.end
+        return minute >= self.start or minute < self.end
+
+
+@dataclass
+class ProcessResult:
+    returncode: int = None
+    stderr: str = None
+    cpu_time: float = None
+    wall_time: float = None
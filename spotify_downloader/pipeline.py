@@ -0,0 +1,542 @@
+from __future__ import annotations
+
+import logging
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable, Iterable, Iterator
+
+from .downloader_song import DownloaderSong
+from .journal import JobJournal
+from .library import LibraryIndex
+from .manifest import SyncManifest
+from .models import (
+    DownloadQueueItem,
+    Lyrics,
+    SongDestination,
+    SongFailure,
+    SongJob,
+    SyncSource,
+)
+from .store import AudioStore
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+@dataclass
+class PipelineStage:
+    name: str
+    func: Callable = None
+    workers: int = 1
+
+
+class Pipeline:
+    def __init__(
+        self,
+        stages: list[PipelineStage],
+        queue_size: int = 8,
+        on_error: Callable = None,
+    ):
+        self.stages = stages
+        self.queue_size = queue_size
+        self.on_error = on_error
+
+    def run(self, jobs: Iterable) -> None:
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in self.stages]
+        threads = []
+        for stage_index, stage in enumerate(self.stages):
+            input_queue = queues[stage_index]
+            output_queue = (
+                queues[stage_index + 1] if stage_index + 1 < len(queues) else None
+            )
+            remaining_workers = [max(stage.workers, 1)]
+            lock = threading.Lock()
+            for worker_index in range(remaining_workers[0]):
+                thread = threading.Thread(
+                    target=self._worker,
+                    args=(stage, input_queue, output_queue, remaining_workers, lock),
+                    name=f"{stage.name}-{worker_index}",
+                    daemon=True,
+                )
+                thread.start()
+                threads.append(thread)
+        try:
+            for job in jobs:
+                queues[0].put(job)
+        finally:
+            queues[0].put(_STOP)
+            for thread in threads:
+                thread.join()
+
+    def _worker(
+        self,
+        stage: PipelineStage,
+        input_queue: queue.Queue,
+        output_queue: queue.Queue | None,
+        remaining_workers: list[int],
+        lock: threading.Lock,
+    ):
+        while True:
+            job = input_queue.get()
+            if job is _STOP:
+                with lock:
+                    remaining_workers[0] -= 1
+                    is_last = remaining_workers[0] == 0
+                if is_last:
+                    if output_queue is not None:
+                        output_queue.put(_STOP)
+                else:
+                    input_queue.put(_STOP)
+                return
+            try:
+                result = stage.func(job)
+            except Exception as e:
+                if self.on_error is not None:
+                    self.on_error(stage, job, e)
+                else:
+                    logger.error(f'Stage "{stage.name}" failed: {e}')
+                continue
+            if result is not None and output_queue is not None:
+                output_queue.put(result)
+
+
+class SongPipeline:
+    def __init__(
+        self,
+        downloader_song: DownloaderSong,
+        metadata_workers: int = 4,
+        download_workers: int = 4,
+        remux_workers: int = None,
+        tag_workers: int = 2,
+        queue_size: int = 8,
+        journal: JobJournal = None,
+        lyrics: bool = False,
+        lyrics_workers: int = 2,
+        store: AudioStore = None,
+        library: LibraryIndex = None,
+    ):
+        self.downloader_song = downloader_song
+        self.downloader = downloader_song.downloader
+        self.spotify_api = downloader_song.downloader.spotify_api
+        self.metrics = downloader_song.downloader.spotify_api.metrics
+        self.metadata_workers = metadata_workers
+        self.download_workers = download_workers
+        self.remux_workers = (
+            remux_workers
+            if remux_workers is not None
+            else downloader_song.downloader.process_executor.max_processes
+        )
+        self.tag_workers = tag_workers
+        self.queue_size = queue_size
+        self.journal = journal if journal is not None else JobJournal()
+        self.lyrics = lyrics
+        self.lyrics_workers = lyrics_workers
+        self.lyrics_executor = None
+        self.store = store if store is not None else AudioStore()
+        self.library = library if library is not None else LibraryIndex()
+        self.failed = []
+        # Only unfinished jobs are kept, so memory doesn't grow with the playlist size
+        self.jobs = {}
+        self._finalize_lock = threading.Lock()
+
+    @staticmethod
+    def get_final_path(folder_path: Path, track: DownloadQueueItem) -> Path:
+        return folder_path.joinpath(f"{track.album_artist} - {track.name}.m4a")
+
+    @staticmethod
+    def get_existing_path(
+        sources: list[SyncSource],
+        track: DownloadQueueItem,
+    ) -> Path | None:
+        metadata_hash = SyncManifest.get_metadata_hash(track)
+        for source in sources:
+            entry = source.manifest.tracks.get(track.id)
+            if entry is None or entry["metadata_hash"] != metadata_hash:
+                continue
+            existing_path = source.manifest.get_track_path(track.id)
+            if existing_path.exists():
+                return existing_path
+        return None
+
+    @staticmethod
+    def has_changed(sources: list[SyncSource], track: DownloadQueueItem) -> bool:
+        metadata_hash = SyncManifest.get_metadata_hash(track)
+        for source in sources:
+            entry = source.manifest.tracks.get(track.id)
+            if entry is not None and entry["metadata_hash"] != metadata_hash:
+                return True
+        return False
+
+    def get_jobs(
+        self,
+        changes: Iterable[tuple[SyncSource, list[DownloadQueueItem]]],
+    ) -> Iterator[SongJob]:
+        job_count = 0
+        sources = []
+        for source, tracks in changes:
+            if not any(i is source for i in sources):
+                sources.append(source)
+            pending_jobs = []
+            for track in tracks:
+                final_path = self.get_final_path(source.folder_path, track)
+                # Files in the library carry the tags of the old metadata
+                is_changed = self.has_changed(sources, track)
+                if track.id not in source.manifest.tracks and not is_changed:
+                    existing_path = self.library.get(
+                        track.id, track.isrc, source.folder_path
+                    )
+                    if existing_path is None and self.library.has_path(final_path):
+                        existing_path = final_path
+                    if existing_path is not None:
+                        source.manifest.add_track(
+                            source.url_info.id, track, existing_path
+                        )
+                        self.metrics.increment("tracks_skipped")
+                        logger.info(
+                            f"(Skipping) {track.album_artist} - {track.name} "
+                            f'already exists as "{existing_path.name}"'
+                        )
+                        continue
+                destination = SongDestination(source, final_path)
+                if self.add_destination(track.id, destination):
+                    continue
+                job_count += 1
+                job = SongJob(index=job_count, track=track)
+                job.destinations.append(destination)
+                with self._finalize_lock:
+                    self.jobs[track.id] = job
+                existing_path = self.store.get(job.track, self.downloader_song.codec)
+                if existing_path is None:
+                    existing_path = self.get_existing_path(sources, job.track)
+                    if existing_path is None and not is_changed:
+                        existing_path = self.library.get(job.track.id, job.track.isrc)
+                    if existing_path is not None:
+                        existing_path = self.store.add(
+                            existing_path,
+                            job.track,
+                            self.downloader_song.codec,
+                            move=False,
+                        )
+                if existing_path is not None:
+                    logger.info(
+                        f'({job.progress}) Linking "{job.track.name}" from "{existing_path}"'
+                    )
+                    if self.lyrics_executor is not None:
+                        self.lyrics_executor.submit(self.link_with_lyrics, job, existing_path)
+                    else:
+                        self.finalize(job, existing_path)
+                    self.metrics.increment("tracks_linked")
+                    continue
+                pending_jobs.append(job)
+            self.prefetch_albums(pending_jobs)
+            yield from pending_jobs
+
+    def link_with_lyrics(self, job: SongJob, existing_path: Path):
+        # Linked tracks skip the pipeline but still need their .lrc sidecar
+        try:
+            job.lyrics = self.get_lyrics(job.track.id)
+        except Exception as e:
+            logger.warning(f"({job.progress}) Failed to get lyrics, skipping them: {e}")
+        try:
+            self.finalize(job, existing_path)
+        except Exception as e:
+            self.failed.append(SongFailure(job, "link", str(e)))
+            self.metrics.increment("tracks_failed")
+            logger.error(
+                f'({job.progress}) Failed to link "{job.track.name}"! Error: {e}'
+            )
+
+    def add_destination(self, track_id: str, destination: SongDestination) -> bool:
+        # Tracks that were already finalized get a new job that links from the store
+        with self._finalize_lock:
+            job = self.jobs.get(track_id)
+            if job is None:
+                return False
+            job.destinations.append(destination)
+            return True
+
+    def release_job(self, job: SongJob):
+        with self._finalize_lock:
+            if self.jobs.get(job.track.id) is job:
+                del self.jobs[job.track.id]
+        job.tags = None
+        job.lyrics = None
+        job.lyrics_future = None
+
+    def prefetch_albums(self, jobs: list[SongJob]):
+        album_ids = [
+            job.track.album_id for job in jobs if job.track.album_id is not None
+        ]
+        if not album_ids:
+            return
+        logger.debug(f"Getting metadata for {len(set(album_ids))} albums")
+        try:
+            with self.metrics.time("albums"):
+                albums = self.spotify_api.get_albums(album_ids)
+        except Exception as e:
+            logger.warning(f"Failed to batch album metadata, falling back: {e}")
+            return
+        for album in albums.values():
+            self.downloader_song.get_album_tags(album)
+
+    def get_lyrics(self, track_id: str) -> Lyrics:
+        with self.metrics.time("lyrics"):
+            return self.downloader_song.get_lyrics(track_id)
+
+    def stage_metadata(self, job: SongJob) -> SongJob | None:
+        logger.info(f'({job.progress}) Downloading "{job.track.name}"')
+        track_id = job.track.id
+        if self.lyrics_executor is not None:
+            job.lyrics_future = self.lyrics_executor.submit(self.get_lyrics, track_id)
+        logger.debug("Getting GID metadata")
+        gid = self.spotify_api.track_id_to_gid(track_id)
+        with self.metrics.time("gid_metadata"):
+            metadata_gid = self.spotify_api.get_gid_metadata(gid)
+        logger.debug("Getting album metadata")
+        with self.metrics.time("album"):
+            album_tags = self.downloader_song.get_album_tags_by_id(
+                job.track.album_id
+                or self.spotify_api.gid_to_track_id(metadata_gid["album"]["gid"])
+            )
+        logger.debug("Getting track credits")
+        with self.metrics.time("credits"):
+            track_credits = self.spotify_api.get_track_credits(track_id)
+        job.tags = self.downloader_song.get_tags(
+            metadata_gid,
+            album_tags,
+            track_credits,
+        )
+        if job.tags.get("cover") is not None:
+            logger.debug("Getting cover")
+            try:
+                with self.metrics.time("cover"):
+                    self.downloader.get_image_bytes(job.tags["cover"])
+            except Exception as e:
+                logger.warning(f"({job.progress}) Failed to get cover, skipping it: {e}")
+                job.tags["cover"] = None
+        logger.debug("Getting file info")
+        job.file_id = self.downloader_song.get_file_id(metadata_gid)
+        if not job.file_id:
+            logger.error(
+                f"({job.progress}) Track not available on Spotify's "
+                "servers and no alternative found, skipping"
+            )
+            self.metrics.increment("tracks_unavailable")
+            self.release_job(job)
+            return None
+        temp_path = self.downloader.temp_path
+        job.encrypted_path = temp_path.joinpath(f"{track_id}_encrypted.m4a")
+        job.decrypted_path = temp_path.joinpath(f"{track_id}_decrypted.m4a")
+        job.remuxed_path = temp_path.joinpath(f"{track_id}_remuxed.m4a")
+        self.resume(job)
+        if job.decryption_key is None:
+            logger.debug("Getting PSSH")
+            with self.metrics.time("pssh"):
+                pssh = self.spotify_api.get_pssh(job.file_id)
+            logger.debug("Getting decryption key")
+            with self.metrics.time("decryption_key"):
+                job.decryption_key = self.downloader_song.get_decryption_key(pssh)
+        if not JobJournal.has_reached(job.stage, "downloaded"):
+            logger.debug("Getting stream URL")
+            with self.metrics.time("stream_url"):
+                job.stream_urls = self.spotify_api.get_stream_urls(job.file_id)
+        if job.stage is None:
+            job.stage = "metadata"
+        self.journal.set_stage(track_id, job.stage, job.file_id, job.decryption_key)
+        return job
+
+    def get_temp_paths(self, job: SongJob) -> list[Path]:
+        return [
+            job.encrypted_path,
+            self.downloader_song.http_downloader.get_part_path(job.encrypted_path),
+            self.downloader_song.http_downloader.get_parallel_path(job.encrypted_path),
+            job.decrypted_path,
+            job.remuxed_path,
+        ]
+
+    def resume(self, job: SongJob):
+        entry = self.journal.get(job.track.id)
+        if entry is None:
+            return
+        if entry["file_id"] != job.file_id:
+            logger.debug("Audio file changed since the last run, discarding partial files")
+            for temp_path in self.get_temp_paths(job):
+                temp_path.unlink(missing_ok=True)
+            self.journal.discard(job.track.id)
+            return
+        job.decryption_key = entry["decryption_key"]
+        job.stage = entry["stage"]
+        if JobJournal.has_reached(job.stage, "remuxed") and not job.remuxed_path.exists():
+            job.stage = "downloaded"
+        if job.stage == "downloaded" and not job.encrypted_path.exists():
+            job.stage = "metadata"
+        if job.stage != "metadata":
+            logger.info(f'({job.progress}) Resuming "{job.track.name}" after {job.stage}')
+            self.metrics.increment("tracks_resumed")
+
+    def stage_download(self, job: SongJob) -> SongJob:
+        if JobJournal.has_reached(job.stage, "downloaded"):
+            job.is_remuxed = JobJournal.has_reached(job.stage, "remuxed")
+            return job
+        if self.downloader_song.can_stream:
+            logger.debug(f'Streaming to "{job.remuxed_path}"')
+            try:
+                with self.metrics.time("download_remux"):
+                    self.downloader_song.download_remux_stream(
+                        job.stream_urls,
+                        job.remuxed_path,
+                        job.decryption_key,
+                    )
+                self.metrics.add_bytes("download", job.remuxed_path.stat().st_size)
+                job.is_remuxed = True
+                self.set_stage(job, "remuxed")
+                return job
+            except Exception as e:
+                logger.warning(
+                    f"({job.progress}) Streaming remux failed, "
+                    f"falling back to a temporary file: {e}"
+                )
+                job.remuxed_path.unlink(missing_ok=True)
+        logger.debug(f'Downloading to "{job.encrypted_path}"')
+        with self.metrics.time("download"):
+            self.downloader_song.download(job.encrypted_path, job.stream_urls)
+        self.metrics.add_bytes("download", job.encrypted_path.stat().st_size)
+        self.set_stage(job, "downloaded")
+        return job
+
+    def stage_remux(self, job: SongJob) -> SongJob:
+        if not job.is_remuxed:
+            logger.debug(f'Decrypting/Remuxing to "{job.remuxed_path}"')
+            try:
+                with self.metrics.time("remux"):
+                    self.downloader_song.remux(
+                        job.encrypted_path,
+                        job.decrypted_path,
+                        job.remuxed_path,
+                        job.decryption_key,
+                    )
+            except Exception:
+                # Resuming would remux the same file again, so the next run starts over
+                for temp_path in self.get_temp_paths(job):
+                    temp_path.unlink(missing_ok=True)
+                job.stage = None
+                self.journal.discard(job.track.id)
+                raise
+            self.set_stage(job, "remuxed")
+        job.encrypted_path.unlink(missing_ok=True)
+        job.decrypted_path.unlink(missing_ok=True)
+        return job
+
+    def wait_for_lyrics(self, job: SongJob):
+        if job.lyrics_future is None:
+            return
+        try:
+            job.lyrics = job.lyrics_future.result()
+        except Exception as e:
+            logger.warning(f"({job.progress}) Failed to get lyrics, skipping them: {e}")
+            job.lyrics = Lyrics()
+        job.lyrics_future = None
+        if job.lyrics.unsynced:
+            job.tags["lyrics"] = job.lyrics.unsynced
+        else:
+            self.metrics.increment("tracks_without_lyrics")
+
+    def stage_tag(self, job: SongJob) -> SongJob:
+        self.wait_for_lyrics(job)
+        if not JobJournal.has_reached(job.stage, "tagged"):
+            logger.debug("Applying tags")
+            with self.metrics.time("tag"):
+                self.downloader.apply_tags(job.remuxed_path, job.tags)
+            self.set_stage(job, "tagged")
+        store_path = self.store.get_path(job.track.id, self.downloader_song.codec)
+        logger.debug(f'Moving to "{store_path}"')
+        with self.metrics.time("move"):
+            self.store.add(job.remuxed_path, job.track, self.downloader_song.codec)
+            self.finalize(job, store_path)
+        self.set_stage(job, "complete")
+        self.metrics.add_bytes("written", store_path.stat().st_size)
+        self.metrics.increment("tracks_downloaded")
+        return job
+
+    def set_stage(self, job: SongJob, stage: str):
+        job.stage = stage
+        self.journal.set_stage(job.track.id, stage)
+
+    def finalize(self, job: SongJob, downloaded_path: Path):
+        with self._finalize_lock:
+            self.jobs.pop(job.track.id, None)
+        try:
+            for destination in job.destinations:
+                self.finalize_destination(job, destination, downloaded_path)
+        finally:
+            self.release_job(job)
+
+    def finalize_destination(
+        self,
+        job: SongJob,
+        destination: SongDestination,
+        downloaded_path: Path,
+    ):
+        manifest = destination.source.manifest
+        previous_path = manifest.get_track_path(job.track.id)
+        if destination.final_path != downloaded_path:
+            logger.debug(f'Linking to "{destination.final_path}"')
+            self.store.link(downloaded_path, destination.final_path)
+        self.store.add_reference(
+            job.track.id, self.downloader_song.codec, destination.final_path
+        )
+        if previous_path is not None and previous_path != destination.final_path:
+            previous_path.unlink(missing_ok=True)
+            self.downloader_song.get_lrc_path(previous_path).unlink(missing_ok=True)
+            self.library.remove(previous_path)
+            self.store.release(job.track.id, self.downloader_song.codec, previous_path)
+        self.library.add(destination.final_path, job.track.id, job.track.isrc)
+        if job.lyrics is not None and job.lyrics.synced:
+            self.downloader_song.save_lrc(
+                self.downloader_song.get_lrc_path(destination.final_path),
+                job.lyrics.synced,
+            )
+        manifest.add_track(
+            destination.source.url_info.id,
+            job.track,
+            destination.final_path,
+            self.store.get_content_hash(job.track.id, self.downloader_song.codec),
+        )
+
+    def on_error(self, stage: PipelineStage, job: SongJob, error: Exception):
+        self.release_job(job)
+        self.failed.append(SongFailure(job, stage.name, str(error)))
+        self.metrics.increment("tracks_failed")
+        logger.error(
+            f'({job.progress}) Failed to download "{job.track.name}" '
+            f"during {stage.name}! Error: {error}"
+        )
+
+    def run(
+        self,
+        changes: Iterable[tuple[SyncSource, list[DownloadQueueItem]]],
+    ) -> None:
+        pipeline = Pipeline(
+            [
+                PipelineStage("metadata", self.stage_metadata, self.metadata_workers),
+                PipelineStage("download", self.stage_download, self.download_workers),
+                PipelineStage("remux", self.stage_remux, self.remux_workers),
+                PipelineStage("tag", self.stage_tag, self.tag_workers),
+            ],
+            queue_size=self.queue_size,
+            on_error=self.on_error,
+        )
+        if self.lyrics:
+            self.lyrics_executor = ThreadPoolExecutor(
+                self.lyrics_workers, thread_name_prefix="lyrics"
+            )
+        try:
+            pipeline.run(self.get_jobs(changes))
+        finally:
+            if self.lyrics_executor is not None:
+                self.lyrics_executor.shutdown()
+                self.lyrics_executor = None
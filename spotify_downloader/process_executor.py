@@ -0,0 +1,113 @@
+from __future__ import annotations
+
+import logging
+import os
+import subprocess
+import threading
+import time
+
+from .metrics import RunMetrics
+from .models import ProcessResult
+
+logger = logging.getLogger(__name__)
+
+
+def get_cpu_count() -> int:
+    if hasattr(os, "sched_getaffinity"):
+        return max(len(os.sched_getaffinity(0)), 1)
+    return os.cpu_count() or 1
+
+
+class ProcessExecutor:
+    STDERR_TAIL_LENGTH = 2000
+
+    def __init__(
+        self,
+        max_processes: int = None,
+        timeout: float = 300.0,
+        metrics: RunMetrics = None,
+    ):
+        self.max_processes = (
+            max_processes if max_processes is not None else get_cpu_count()
+        )
+        self.timeout = timeout
+        self.metrics = metrics if metrics is not None else RunMetrics()
+        self._semaphore = threading.BoundedSemaphore(self.max_processes)
+
+    @staticmethod
+    def get_exit_code(status: int) -> int:
+        if os.WIFSIGNALED(status):
+            return -os.WTERMSIG(status)
+        return os.WEXITSTATUS(status)
+
+    def _wait(
+        self,
+        process: subprocess.Popen,
+        timeout: float,
+    ) -> tuple[bytes, float | None, bool]:
+        if not hasattr(os, "wait4"):
+            try:
+                _, stderr = process.communicate(timeout=timeout)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                _, stderr = process.communicate()
+                return stderr, None, True
+            return stderr, None, False
+        timed_out = threading.Event()
+
+        def kill():
+            timed_out.set()
+            process.kill()
+
+        timer = threading.Timer(timeout, kill)
+        timer.start()
+        try:
+            stderr = process.stderr.read()
+            _, status, rusage = os.wait4(process.pid, 0)
+        finally:
+            timer.cancel()
+            process.stderr.close()
+        process.returncode = self.get_exit_code(status)
+        return stderr, rusage.ru_utime + rusage.ru_stime, timed_out.is_set()
+
+    def run(
+        self,
+        args: list,
+        name: str = "process",
+        timeout: float = None,
+    ) -> ProcessResult:
+        args = [str(i) for i in args]
+        timeout = timeout if timeout is not None else self.timeout
+        with self._semaphore:
+            start_time = time.perf_counter()
+            process = subprocess.Popen(
+                args,
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.PIPE,
+            )
+            stderr, cpu_time, timed_out = self._wait(process, timeout)
+            wall_time = time.perf_counter() - start_time
+        result = ProcessResult(
+            returncode=process.returncode,
+            stderr=stderr.decode("utf8", "replace"),
+            cpu_time=cpu_time,
+            wall_time=wall_time,
+        )
+        self.metrics.record(f"{name}_wall", wall_time)
+        if cpu_time is not None:
+            self.metrics.record(f"{name}_cpu", cpu_time)
+        stderr_tail = result.stderr[-self.STDERR_TAIL_LENGTH :].strip()
+        if timed_out:
+            self.metrics.increment(f"{name}_timeouts")
+            raise Exception(
+                f"{os.path.basename(args[0])} timed out after {timeout:.0f}s: {stderr_tail}"
+            )
+        if result.returncode != 0:
+            raise Exception(
+                f"{os.path.basename(args[0])} exited with code {result.returncode}: "
+                f"{stderr_tail}"
+            )
+        if stderr_tail:
+            logger.debug(f"{os.path.basename(args[0])}: {stderr_tail}")
+        return result
@@ -0,0 +1,244 @@
+from __future__ import annotations
+
+import collections
+import contextlib
+import datetime
+import threading
+import time
+import urllib.parse
+from typing import Iterator
+
+from .models import BandwidthWindow
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float):
+        self.tokens = min(
+            self.capacity,
+            self.tokens + (now - self.updated_at) * self.rate,
+        )
+        self.updated_at = now
+
+    def _reserve(self, tokens: float) -> float:
+        with self._lock:
+            self._refill(time.monotonic())
+            if self.tokens >= tokens:
+                self.tokens -= tokens
+                return 0
+            return (tokens - self.tokens) / self.rate
+
+    def set_rate(self, rate: float, capacity: float):
+        with self._lock:
+            self._refill(time.monotonic())
+            self.rate = rate
+            self.capacity = capacity
+            self.tokens = min(self.tokens, capacity)
+
+    def _borrow(self, tokens: float) -> float:
+        with self._lock:
+            self._refill(time.monotonic())
+            self.tokens -= tokens
+            return max(-self.tokens / self.rate, 0)
+
+    def acquire(self, tokens: float = 1):
+        while True:
+            wait_time = self._reserve(tokens)
+            if wait_time == 0:
+                return
+            time.sleep(wait_time)
+
+
+class AdaptiveRateLimiter(TokenBucket):
+    def __init__(
+        self,
+        rate: float = 10.0,
+        min_rate: float = 0.5,
+        max_rate: float = None,
+        increase_step: float = 0.1,
+        decrease_factor: float = 0.5,
+    ):
+        super().__init__(rate)
+        self.min_rate = min_rate
+        self.max_rate = max_rate if max_rate is not None else rate * 2
+        self.increase_step = increase_step
+        self.decrease_factor = decrease_factor
+        self.requests = 0
+        self.throttled = 0
+        self.retries = 0
+        self.paused_until = 0.0
+
+    def acquire(self, tokens: float = 1):
+        wait_time = self.paused_until - time.monotonic()
+        if wait_time > 0:
+            time.sleep(wait_time)
+        super().acquire(tokens)
+        with self._lock:
+            self.requests += 1
+
+    def on_success(self):
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.increase_step)
+
+    def on_retry(self):
+        with self._lock:
+            self.retries += 1
+
+    def on_throttle(self, retry_after: float = None):
+        with self._lock:
+            self.throttled += 1
+            self.rate = max(self.min_rate, self.rate * self.decrease_factor)
+            self.tokens = min(self.tokens, 0)
+            if retry_after:
+                self.paused_until = max(
+                    self.paused_until, time.monotonic() + retry_after
+                )
+
+    def metrics(self) -> dict:
+        with self._lock:
+            return {
+                "rate": round(self.rate, 3),
+                "requests": self.requests,
+                "throttled": self.throttled,
+                "retries": self.retries,
+                "paused_for": round(max(self.paused_until - time.monotonic(), 0), 3),
+            }
+
+
+class BandwidthScheduler:
+    def __init__(
+        self,
+        rate: float = None,
+        windows: list[BandwidthWindow] = None,
+        max_host_connections: int = None,
+        burst: float = 0.25,
+    ):
+        self.rate = rate
+        self.windows = windows or []
+        self.max_host_connections = max_host_connections
+        self.burst = burst
+        self.bucket = None
+        self.bytes = 0
+        self.waited_seconds = 0.0
+        self.active_transfers = 0
+        self.active_seconds = 0.0
+        self.active_since = None
+        self._host_semaphores = {}
+        self._host_transfers = collections.Counter()
+        self._lock = threading.Lock()
+
+    def reset(self):
+        with self._lock:
+            self.bytes = 0
+            self.waited_seconds = 0.0
+            self.active_seconds = 0.0
+            if self.active_since is not None:
+                self.active_since = time.monotonic()
+
+    def get_rate(self, now: datetime.datetime = None) -> float | None:
+        now = now if now is not None else datetime.datetime.now()
+        minute = now.hour * 60 + now.minute
+        for window in self.windows:
+            if window.contains(minute):
+                return window.rate
+        return self.rate
+
+    def get_bucket(self) -> TokenBucket | None:
+        rate = self.get_rate()
+        if rate is None:
+            self.bucket = None
+        elif self.bucket is None:
+            self.bucket = TokenBucket(rate, rate * self.burst)
+            # Start empty so the first burst doesn't push the average over the cap
+            self.bucket.tokens = 0
+        elif self.bucket.rate != rate:
+            self.bucket.set_rate(rate, rate * self.burst)
+        return self.bucket
+
+    def get_share(self) -> float | None:
+        rate = self.get_rate()
+        if rate is None:
+            return None
+        with self._lock:
+            return rate / max(self.active_transfers, 1)
+
+    def consume(self, size: int) -> float:
+        with self._lock:
+            self.bytes += size
+            bucket = self.get_bucket()
+        if bucket is None:
+            return 0.0
+        # Tokens may go negative so chunks larger than the burst are paid back by waiting
+        wait_time = bucket._borrow(size)
+        if wait_time:
+            time.sleep(wait_time)
+            with self._lock:
+                self.waited_seconds += wait_time
+        return wait_time
+
+    def record(self, size: int):
+        with self._lock:
+            self.bytes += size
+
+    def _get_host_semaphore(self, host: str) -> threading.BoundedSemaphore | None:
+        if self.max_host_connections is None:
+            return None
+        with self._lock:
+            semaphore = self._host_semaphores.get(host)
+            if semaphore is None:
+                semaphore = self._host_semaphores[host] = threading.BoundedSemaphore(
+                    self.max_host_connections
+                )
+            return semaphore
+
+    @contextlib.contextmanager
+    def slot(self, url: str) -> Iterator[None]:
+        host = urllib.parse.urlsplit(url).netloc
+        semaphore = self._get_host_semaphore(host)
+        if semaphore is not None:
+            semaphore.acquire()
+        with self._lock:
+            if not self.active_transfers:
+                self.active_since = time.monotonic()
+            self.active_transfers += 1
+            self._host_transfers[host] += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.active_transfers -= 1
+                self._host_transfers[host] -= 1
+                if not self.active_transfers:
+                    self.active_seconds += time.monotonic() - self.active_since
+                    self.active_since = None
+            if semaphore is not None:
+                semaphore.release()
+
+    @property
+    def bytes_per_second(self) -> float:
+        with self._lock:
+            active_seconds = self.active_seconds
+            if self.active_since is not None:
+                active_seconds += time.monotonic() - self.active_since
+            return self.bytes / active_seconds if active_seconds else 0.0
+
+    def metrics(self) -> dict:
+        rate = self.get_rate()
+        bytes_per_second = self.bytes_per_second
+        with self._lock:
+            return {
+                "rate": rate,
+                "bytes": self.bytes,
+                "bytes_per_second": round(bytes_per_second, 2),
+                "waited_seconds": round(self.waited_seconds, 3),
+                "active_transfers": self.active_transfers,
+                "host_transfers": {
+                    host: count for host, count in self._host_transfers.items() if count
+                },
+            }
@@ -0,0 +1,104 @@
+from __future__ import annotations
+
+import datetime
+import email.utils
+import logging
+import random
+import time
+
+import requests
+
+from .metrics import RunMetrics
+from .ratelimit import AdaptiveRateLimiter
+
+logger = logging.getLogger(__name__)
+
+
+class RetrySession(requests.Session):
+    RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+    def __init__(
+        self,
+        rate_limiter: AdaptiveRateLimiter = None,
+        max_retries: int = 5,
+        backoff_base: float = 1.0,
+        backoff_max: float = 60.0,
+        max_retry_after: float = 300.0,
+        metrics: RunMetrics = None,
+    ):
+        super().__init__()
+        if metrics is not None:
+            self.hooks["response"].append(metrics.on_response)
+        self.rate_limiter = rate_limiter
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.max_retry_after = max_retry_after
+        self.on_unauthorized = None
+
+    def get_backoff(self, attempt: int) -> float:
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2**attempt))
+
+    @staticmethod
+    def get_retry_after(response: requests.Response) -> float | None:
+        retry_after = response.headers.get("Retry-After")
+        if retry_after is None:
+            return None
+        if retry_after.isdigit():
+            return float(retry_after)
+        try:
+            retry_after_datetime = email.utils.parsedate_to_datetime(retry_after)
+        except (TypeError, ValueError):
+            return None
+        return max(
+            (
+                retry_after_datetime - datetime.datetime.now(datetime.timezone.utc)
+            ).total_seconds(),
+            0,
+        )
+
+    def request(self, method: str, url: str, *args, **kwargs) -> requests.Response:
+        is_reauthorized = False
+        for attempt in range(self.max_retries + 1):
+            is_last_attempt = attempt == self.max_retries
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire()
+            try:
+                response = super().request(method, url, *args, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if is_last_attempt:
+                    raise
+                delay = self.get_backoff(attempt)
+                logger.debug(f"{method} {url} failed ({e}), retrying in {delay:.1f}s")
+            else:
+                if (
+                    response.status_code == 401
+                    and self.on_unauthorized is not None
+                    and not is_reauthorized
+                    and not is_last_attempt
+                ):
+                    logger.debug(f"{method} {url} returned 401, refreshing the token")
+                    response.close()
+                    self.on_unauthorized(response)
+                    is_reauthorized = True
+                    continue
+                if response.status_code not in self.RETRY_STATUS_CODES or is_last_attempt:
+                    if self.rate_limiter is not None and response.ok:
+                        self.rate_limiter.on_success()
+                    return response
+                retry_after = self.get_retry_after(response)
+                if response.status_code == 429 and self.rate_limiter is not None:
+                    self.rate_limiter.on_throttle(retry_after)
+                if retry_after is not None and retry_after > self.max_retry_after:
+                    return response
+                delay = (
+                    retry_after if retry_after is not None else self.get_backoff(attempt)
+                )
+                logger.debug(
+                    f"{method} {url} returned {response.status_code}, "
+                    f"retrying in {delay:.1f}s"
+                )
+                response.close()
+            if self.rate_limiter is not None:
+                self.rate_limiter.on_retry()
+            time.sleep(delay)
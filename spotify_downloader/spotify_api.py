@@ -1,15 +1,30 @@
 from __future__ import annotations
 
-import functools
+import collections
+import hashlib
 import json
 import re
+import threading
 import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
 from http.cookiejar import MozillaCookieJar
 from pathlib import Path
+from typing import Iterator
 
 import base62
 import requests
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+from .cache import MetadataCache, cached
+from .metrics import RunMetrics
+from .ratelimit import AdaptiveRateLimiter, TokenBucket
+from .retry_session import RetrySession
+
 
 class SpotifyApi:
     SPOTIFY_HOME_PAGE_URL = "https://open.spotify.com/"
@@ -27,24 +42,70 @@ class SpotifyApi:
         "{file_id}?version=10000000&product=9&platform=39&alt=json"
     )
     METADATA_API_URL = "https://api.spotify.com/v1/{type}/{track_id}"
+    SEVERAL_METADATA_API_URL = "https://api.spotify.com/v1/{type}"
     PATHFINDER_API_URL = "https://api-partner.spotify.com/pathfinder/v1/query"
     TRACK_CREDITS_API_URL = "https://spclient.wg.spotify.com/track-credits-view/v0/experimental/{track_id}/credits"
-    EXTEND_TRACK_COLLECTION_WAIT_TIME = 0.5
+
+    PLAYLIST_TRACK_FIELDS = (
+        "track(id,name,artists(name),album(id,name,artists(name)),external_ids(isrc))"
+    )
+
+    ALBUMS_BATCH_SIZE = 20
+    DEFAULT_TOKEN_LIFETIME = 60 * 60
+    TOKEN_REFRESH_MARGIN = 5 * 60
+    TRACKS_BATCH_SIZE = 50
 
     def __init__(
         self,
         cookies_path: Path = Path("./cookies.txt"),
+        cache: MetadataCache = None,
+        pagination_concurrency: int = 4,
+        pagination_rate: float = 5.0,
+        request_rate: float = 10.0,
+        max_retries: int = 5,
+        metrics: RunMetrics = None,
     ):
         self.cookies_path = cookies_path
-        self._setup_session()
+        self.metrics = metrics if metrics is not None else RunMetrics()
+        self.cache = cache if cache is not None else MetadataCache()
+        self.pagination_concurrency = pagination_concurrency
+        self.pagination_rate_limiter = TokenBucket(pagination_rate)
+        self.rate_limiter = AdaptiveRateLimiter(request_rate)
+        self.max_retries = max_retries
+        self.public_session = RetrySession(
+            self.rate_limiter,
+            max_retries,
+            metrics=self.metrics,
+        )
+        self._session = None
+        self._session_lock = threading.RLock()
+        self._is_fetching_token = False
+        self.token_expires_at = None
+
+    @property
+    def session(self) -> requests.Session:
+        if self._session is None:
+            with self._session_lock:
+                if self._session is None:
+                    self._setup_session()
+        return self._session
+
+    @property
+    def is_premium(self) -> bool:
+        self.session
+        return self._is_premium
 
     def _setup_session(self):
-        self.session = requests.Session()
+        session = RetrySession(
+            self.rate_limiter,
+            self.max_retries,
+            metrics=self.metrics,
+        )
         if self.cookies_path:
             cookies = MozillaCookieJar(self.cookies_path)
             cookies.load(ignore_discard=True, ignore_expires=True)
-            self.session.cookies.update(cookies)
-        self.session.headers.update(
+            session.cookies.update(cookies)
+        session.headers.update(
             {
                 "sec-ch-ua": '"Google Chrome";v="123", "Not:A-Brand";v="8", "Chromium";v="123"',
                 "accept-language": "en-US",
@@ -57,15 +118,79 @@ class SpotifyApi:
                 "sec-ch-ua-platform": '"Windows"',
             }
         )
-        home_page = self.session.get(self.SPOTIFY_HOME_PAGE_URL).text
-        token = re.search(r'accessToken":"(.*?)"', home_page).group(1)
-        self.is_premium = re.search(r'isPremium":(.*?),', home_page).group(1) == "true"
-        self.session.headers.update(
+        session.on_unauthorized = self._on_unauthorized
+        self.cookies_hash = self.get_cookies_hash()
+        self._set_token(session)
+        self._session = session
+
+    def get_cookies_hash(self) -> str:
+        if not self.cookies_path:
+            return "anonymous"
+        return hashlib.sha256(Path(self.cookies_path).read_bytes()).hexdigest()
+
+    def fetch_token(self, session: requests.Session) -> dict:
+        response = session.get(self.SPOTIFY_HOME_PAGE_URL)
+        self._check_response(response)
+        home_page = response.text
+        token_expiration = re.search(r'accessTokenExpirationTimestampMs":(\d+)', home_page)
+        return {
+            "token": re.search(r'accessToken":"(.*?)"', home_page).group(1),
+            "expires_at": (
+                int(token_expiration.group(1)) / 1000
+                if token_expiration is not None
+                else time.time() + self.DEFAULT_TOKEN_LIFETIME
+            ),
+            "is_premium": re.search(r'isPremium":(.*?),', home_page).group(1) == "true",
+        }
+
+    def _set_token(
+        self,
+        session: requests.Session,
+        margin: float = None,
+        force: bool = False,
+    ):
+        margin = margin if margin is not None else self.TOKEN_REFRESH_MARGIN
+        token = None if force else self.cache.get("token", self.cookies_hash, None)
+        if token is None or token["expires_at"] - time.time() <= margin:
+            self._is_fetching_token = True
+            try:
+                token = self.fetch_token(session)
+            finally:
+                self._is_fetching_token = False
+            self.cache.set("token", self.cookies_hash, token)
+        self._is_premium = token["is_premium"]
+        self.token_expires_at = token["expires_at"]
+        session.headers.update(
             {
-                "authorization": f"Bearer {token}",
+                "authorization": f"Bearer {token['token']}",
             }
         )
 
+    def refresh_token(self, margin: float = None):
+        with self._session_lock:
+            if self._session is None:
+                self._setup_session()
+            elif self.token_expires_at - time.time() <= (
+                margin if margin is not None else self.TOKEN_REFRESH_MARGIN
+            ):
+                self._set_token(self._session, margin)
+
+    def reauthorize(self, authorization: str):
+        with self._session_lock:
+            if self._session is None or self._is_fetching_token:
+                return
+            if self._session.headers.get("authorization") == authorization:
+                self._set_token(self._session, force=True)
+
+    def _on_unauthorized(self, response: requests.Response):
+        self.reauthorize(response.request.headers.get("authorization"))
+
+    @staticmethod
+    def get_json(response: requests.Response):
+        if orjson is not None:
+            return orjson.loads(response.content)
+        return response.json()
+
     @staticmethod
     def _check_response(response: requests.Response):
         try:
@@ -83,15 +208,16 @@ class SpotifyApi:
     def gid_to_track_id(gid: str) -> str:
         return base62.encode(int(gid, 16), charset=base62.CHARSET_INVERTED).zfill(22)
 
+    @cached("gid_metadata")
     def get_gid_metadata(self, gid: str) -> dict:
         response = self.session.get(self.GID_METADATA_API_URL.format(gid=gid))
         self._check_response(response)
-        return response.json()
+        return self.get_json(response)
 
     def get_video_manifest(self, gid: str) -> dict:
         response = self.session.get(self.VIDEO_MANIFEST_API_URL.format(gid=gid))
         self._check_response(response)
-        return response.json()
+        return self.get_json(response)
 
     def get_widevine_license_music(self, challenge: bytes) -> bytes:
         response = self.session.post(
@@ -109,42 +235,134 @@ class SpotifyApi:
         self._check_response(response)
         return response.content
 
+    @cached("lyrics")
     def get_lyrics(self, track_id: str) -> dict | None:
         response = self.session.get(self.LYRICS_API_URL.format(track_id=track_id))
         if response.status_code == 404:
             return None
         self._check_response(response)
-        return response.json()
+        return self.get_json(response)
 
     def get_pssh(self, file_id: str) -> str:
-        response = requests.get(self.PSSH_API_URL.format(file_id=file_id))
+        response = self.public_session.get(self.PSSH_API_URL.format(file_id=file_id))
         self._check_response(response)
-        return response.json()["pssh"]
+        return self.get_json(response)["pssh"]
 
-    def get_stream_url(self, file_id: str) -> str:
+    def get_stream_urls(self, file_id: str) -> list[str]:
         response = self.session.get(self.STREAM_URL_API_URL.format(file_id=file_id))
         self._check_response(response)
-        return response.json()["cdnurl"][0]
+        return self.get_json(response)["cdnurl"]
+
+    def get_stream_url(self, file_id: str) -> str:
+        return self.get_stream_urls(file_id)[0]
 
+    @cached("track")
     def get_track(self, track_id: str) -> dict:
         response = self.session.get(
             self.METADATA_API_URL.format(type="tracks", track_id=track_id)
         )
         self._check_response(response)
-        return response.json()
+        return self.get_json(response)
 
-    def extend_track_collection(self, track_collection: dict) -> dict:
-        next_url = track_collection["tracks"]["next"]
-        while next_url is not None:
-            response = self.session.get(next_url)
-            self._check_response(response)
-            next_tracks = response.json()
-            track_collection["tracks"]["items"].extend(next_tracks["items"])
-            next_url = next_tracks["next"]
-            time.sleep(self.EXTEND_TRACK_COLLECTION_WAIT_TIME)
+    def get_several(self, type: str, ids: list[str]) -> list[dict | None]:
+        response = self.session.get(
+            self.SEVERAL_METADATA_API_URL.format(type=type),
+            params={"ids": ",".join(ids)},
+        )
+        self._check_response(response)
+        return self.get_json(response)[type]
+
+    def get_several_cached(
+        self,
+        endpoint: str,
+        type: str,
+        ids: list[str],
+        batch_size: int,
+        extend: bool = False,
+    ) -> dict[str, dict]:
+        items = {}
+        missing_ids = []
+        for item_id in dict.fromkeys(ids):
+            item = self.cache.get(endpoint, item_id, None)
+            if item is None:
+                missing_ids.append(item_id)
+            else:
+                items[item_id] = item
+        for batch_index in range(0, len(missing_ids), batch_size):
+            batch_ids = missing_ids[batch_index : batch_index + batch_size]
+            for item_id, item in zip(batch_ids, self.get_several(type, batch_ids)):
+                if item is None:
+                    continue
+                if extend:
+                    item = self.extend_track_collection(item)
+                self.cache.set(endpoint, item_id, item)
+                items[item_id] = item
+        return items
+
+    def get_tracks(self, track_ids: list[str]) -> dict[str, dict]:
+        return self.get_several_cached(
+            "track", "tracks", track_ids, self.TRACKS_BATCH_SIZE
+        )
+
+    def get_albums(self, album_ids: list[str]) -> dict[str, dict]:
+        return self.get_several_cached(
+            "album", "albums", album_ids, self.ALBUMS_BATCH_SIZE, extend=True
+        )
+
+    def get_page_urls(self, tracks: dict) -> list[str]:
+        next_url = urllib.parse.urlsplit(tracks["next"])
+        query = dict(urllib.parse.parse_qsl(next_url.query))
+        limit = int(query.get("limit", tracks["limit"]))
+        page_urls = []
+        for offset in range(int(query["offset"]), tracks["total"], limit):
+            query.update({"offset": str(offset), "limit": str(limit)})
+            page_urls.append(
+                next_url._replace(query=urllib.parse.urlencode(query)).geturl()
+            )
+        return page_urls
+
+    def get_page(self, page_url: str, fields: str = None) -> dict:
+        self.pagination_rate_limiter.acquire()
+        response = self.session.get(
+            page_url, params={"fields": fields} if fields is not None else None
+        )
+        self._check_response(response)
+        return self.get_json(response)
+
+    def iter_pages(self, tracks: dict, page_fields: str = None) -> Iterator[dict]:
+        if tracks["next"] is None:
+            return
+        if tracks.get("total") is None or "offset=" not in tracks["next"]:
+            next_url = tracks["next"]
+            while next_url is not None:
+                next_tracks = self.get_page(next_url, page_fields)
+                yield next_tracks
+                next_url = next_tracks["next"]
+        else:
+            # Only a few pages run ahead of the consumer so they aren't all held in memory
+            with ThreadPoolExecutor(self.pagination_concurrency) as executor:
+                page_futures = collections.deque()
+                for page_url in self.get_page_urls(tracks):
+                    page_futures.append(
+                        executor.submit(self.get_page, page_url, page_fields)
+                    )
+                    if len(page_futures) > self.pagination_concurrency:
+                        yield page_futures.popleft().result()
+                while page_futures:
+                    yield page_futures.popleft().result()
+
+    def extend_track_collection(
+        self,
+        track_collection: dict,
+        page_fields: str = None,
+    ) -> dict:
+        tracks = track_collection["tracks"]
+        for next_tracks in self.iter_pages(tracks, page_fields):
+            tracks["items"].extend(next_tracks["items"])
+        tracks["next"] = None
         return track_collection
 
-    @functools.lru_cache()
+    @cached("album")
     def get_album(
         self,
         album_id: str,
@@ -154,24 +372,108 @@ class SpotifyApi:
             self.METADATA_API_URL.format(type="albums", track_id=album_id)
         )
         self._check_response(response)
-        album = response.json()
+        album = self.get_json(response)
         if extend:
             album = self.extend_track_collection(album)
         return album
 
+    @cached("playlist")
     def get_playlist(
         self,
         playlist_id: str,
         extend: bool = True,
     ) -> dict:
+        playlist = self.get_playlist_first_page(playlist_id)
+        if extend:
+            playlist = self.extend_track_collection(
+                playlist, self.get_playlist_page_fields()
+            )
+        return playlist
+
+    def get_playlist_first_page(self, playlist_id: str) -> dict:
         response = self.session.get(
-            self.METADATA_API_URL.format(type="playlists", track_id=playlist_id)
+            self.METADATA_API_URL.format(type="playlists", track_id=playlist_id),
+            params={"fields": self.get_playlist_fields()},
         )
         self._check_response(response)
-        playlist = response.json()
-        if extend:
-            playlist = self.extend_track_collection(playlist)
-        return playlist
+        return self.get_json(response)
+
+    def iter_playlist_pages(self, playlist_id: str) -> Iterator[list[dict]]:
+        playlist = self.cache.get("playlist", playlist_id, None)
+        if playlist is not None:
+            yield playlist["tracks"]["items"]
+            return
+        playlist_pages = self.cache.get("playlist_pages", playlist_id, None)
+        if playlist_pages is not None:
+            yield from self.iter_cached_playlist_pages(playlist_id, playlist_pages)
+            return
+        # Pages are cached one by one instead of assembling the whole playlist
+        playlist = self.get_playlist_first_page(playlist_id)
+        page_key = self.get_playlist_page_key(playlist_id, playlist["snapshot_id"])
+        tracks = playlist["tracks"]
+        items = tracks.pop("items")
+        self.cache.set("playlist_page", f"{page_key}:0", items)
+        yield items
+        page_urls = []
+        next_url = tracks["next"]
+        for index, next_tracks in enumerate(
+            self.iter_pages(tracks, self.get_playlist_page_fields()), 1
+        ):
+            page_urls.append(next_url)
+            next_url = next_tracks["next"]
+            self.cache.set("playlist_page", f"{page_key}:{index}", next_tracks["items"])
+            yield next_tracks["items"]
+        self.cache.set(
+            "playlist_pages",
+            playlist_id,
+            {"snapshot_id": playlist["snapshot_id"], "page_urls": page_urls},
+        )
+
+    def iter_cached_playlist_pages(
+        self,
+        playlist_id: str,
+        playlist_pages: dict,
+    ) -> Iterator[list[dict]]:
+        page_key = self.get_playlist_page_key(playlist_id, playlist_pages["snapshot_id"])
+        for index in range(len(playlist_pages["page_urls"]) + 1):
+            items = self.cache.get("playlist_page", f"{page_key}:{index}", None)
+            if items is None:
+                if index == 0:
+                    items = self.get_playlist_first_page(playlist_id)["tracks"]["items"]
+                else:
+                    items = self.get_page(
+                        playlist_pages["page_urls"][index - 1],
+                        self.get_playlist_page_fields(),
+                    )["items"]
+                self.cache.set("playlist_page", f"{page_key}:{index}", items)
+            yield items
+
+    @staticmethod
+    def get_playlist_page_key(playlist_id: str, snapshot_id: str) -> str:
+        return f"{playlist_id}:{snapshot_id}"
+
+    def get_playlist_fields(self) -> str:
+        return (
+            "id,name,snapshot_id,"
+            f"tracks(items({self.PLAYLIST_TRACK_FIELDS}),next,total,limit,offset)"
+        )
+
+    def get_playlist_page_fields(self) -> str:
+        return f"items({self.PLAYLIST_TRACK_FIELDS}),next"
+
+    def expire_playlist(self, playlist_id: str, snapshot_id: str):
+        for endpoint in ("playlist", "playlist_pages"):
+            playlist = self.cache.get(endpoint, playlist_id, None)
+            if playlist is not None and playlist.get("snapshot_id") != snapshot_id:
+                self.cache.invalidate(endpoint, playlist_id)
+
+    def get_playlist_snapshot_id(self, playlist_id: str) -> str:
+        response = self.session.get(
+            self.METADATA_API_URL.format(type="playlists", track_id=playlist_id),
+            params={"fields": "snapshot_id"},
+        )
+        self._check_response(response)
+        return self.get_json(response)["snapshot_id"]
 
     def get_now_playing_view(self, track_id: str, artist_id: str) -> dict:
         response = self.session.get(
@@ -197,11 +499,12 @@ class SpotifyApi:
             },
         )
         self._check_response(response)
-        return response.json()
+        return self.get_json(response)
 
+    @cached("track_credits")
     def get_track_credits(self, track_id: str) -> dict:
         response = self.session.get(
             self.TRACK_CREDITS_API_URL.format(track_id=track_id)
         )
         self._check_response(response)
-        return response.json()
+        return self.get_json(response)
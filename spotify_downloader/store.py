@@ -0,0 +1,158 @@
+from __future__ import annotations
+
+import errno
+import json
+import os
+import shutil
+import threading
+from pathlib import Path
+
+from .enums import LinkMode
+from .manifest import SyncManifest
+from .models import DownloadQueueItem
+
+
+class AudioStore:
+    INDEX_FILE_NAME = "index.json"
+    FICLONE = 0x40049409
+
+    def __init__(
+        self,
+        path: Path = Path("./store"),
+        link_mode: LinkMode = LinkMode.AUTO,
+    ):
+        self.path = path
+        self.index_path = path / self.INDEX_FILE_NAME
+        self.link_mode = link_mode
+        self.entries = {}
+        self._lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        if not self.index_path.exists():
+            return
+        self.entries = json.loads(self.index_path.read_text(encoding="utf8"))
+
+    def save(self):
+        with self._lock:
+            self.path.mkdir(parents=True, exist_ok=True)
+            temp_path = self.index_path.with_suffix(".tmp")
+            temp_path.write_text(json.dumps(self.entries, indent=1), encoding="utf8")
+            os.replace(temp_path, self.index_path)
+
+    @staticmethod
+    def get_key(track_id: str, codec: str) -> str:
+        return f"{track_id}.{codec}"
+
+    def get_path(self, track_id: str, codec: str) -> Path:
+        return self.path / track_id[:2] / f"{self.get_key(track_id, codec)}.m4a"
+
+    def get(self, track: DownloadQueueItem, codec: str) -> Path | None:
+        with self._lock:
+            entry = self.entries.get(self.get_key(track.id, codec))
+        if entry is None or entry["metadata_hash"] != SyncManifest.get_metadata_hash(
+            track
+        ):
+            return None
+        store_path = self.get_path(track.id, codec)
+        if not store_path.exists():
+            return None
+        return store_path
+
+    def get_content_hash(self, track_id: str, codec: str) -> str | None:
+        with self._lock:
+            entry = self.entries.get(self.get_key(track_id, codec))
+        return entry["hash"] if entry is not None else None
+
+    def add(
+        self,
+        source_path: Path,
+        track: DownloadQueueItem,
+        codec: str,
+        move: bool = True,
+    ) -> Path:
+        store_path = self.get_path(track.id, codec)
+        store_path.parent.mkdir(parents=True, exist_ok=True)
+        if move:
+            shutil.move(source_path, store_path)
+        else:
+            self.link(source_path, store_path)
+        content_hash = SyncManifest.get_content_hash(store_path)
+        with self._lock:
+            previous_entry = self.entries.get(self.get_key(track.id, codec), {})
+            self.entries[self.get_key(track.id, codec)] = {
+                "metadata_hash": SyncManifest.get_metadata_hash(track),
+                "hash": content_hash,
+                "paths": previous_entry.get("paths", []),
+            }
+        return store_path
+
+    def add_reference(self, track_id: str, codec: str, final_path: Path):
+        with self._lock:
+            entry = self.entries.get(self.get_key(track_id, codec))
+            if entry is None:
+                return
+            paths = entry.setdefault("paths", [])
+            final_path = str(final_path.absolute())
+            if final_path not in paths:
+                paths.append(final_path)
+
+    def reflink(self, source_path: Path, final_path: Path):
+        import fcntl
+
+        with source_path.open("rb") as source_file, final_path.open("wb") as final_file:
+            try:
+                fcntl.ioctl(final_file.fileno(), self.FICLONE, source_file.fileno())
+            except OSError:
+                final_file.close()
+                final_path.unlink(missing_ok=True)
+                raise
+        shutil.copystat(source_path, final_path)
+
+    def link(self, source_path: Path, final_path: Path):
+        final_path.parent.mkdir(parents=True, exist_ok=True)
+        final_path.unlink(missing_ok=True)
+        if self.link_mode in (LinkMode.AUTO, LinkMode.HARDLINK):
+            try:
+                os.link(source_path, final_path)
+                return
+            except OSError as e:
+                if self.link_mode == LinkMode.HARDLINK or e.errno not in (
+                    errno.EXDEV,
+                    errno.EPERM,
+                    errno.EMLINK,
+                    errno.ENOTSUP,
+                ):
+                    raise
+        if self.link_mode in (LinkMode.AUTO, LinkMode.REFLINK):
+            try:
+                self.reflink(source_path, final_path)
+                return
+            except OSError:
+                if self.link_mode == LinkMode.REFLINK:
+                    raise
+        shutil.copy2(source_path, final_path)
+
+    def release(self, track_id: str, codec: str, final_path: Path) -> bool:
+        store_path = self.get_path(track_id, codec)
+        with self._lock:
+            entry = self.entries.get(self.get_key(track_id, codec))
+            paths = entry.get("paths") if entry is not None else None
+            if paths is not None:
+                final_path = str(final_path.absolute())
+                if final_path in paths:
+                    paths.remove(final_path)
+                if paths:
+                    return False
+        # Entries written before references were tracked fall back to the link count,
+        # which is only meaningful for hardlinks
+        if paths is None:
+            try:
+                if store_path.stat().st_nlink > 1:
+                    return False
+            except FileNotFoundError:
+                pass
+        store_path.unlink(missing_ok=True)
+        with self._lock:
+            self.entries.pop(self.get_key(track_id, codec), None)
+        return True
@@ -0,0 +1,256 @@
+from __future__ import annotations
+
+import logging
+import os
+from pathlib import Path
+from typing import Iterator
+
+from .downloader_song import DownloaderSong
+from .journal import JobJournal
+from .library import LibraryIndex
+from .manifest import SyncManifest
+from .models import DownloadQueueItem, ManifestDiff, SyncResult, SyncSource
+from .pipeline import SongPipeline
+from .store import AudioStore
+
+logger = logging.getLogger(__name__)
+
+
+class Syncer:
+    def __init__(
+        self,
+        downloader_song: DownloaderSong,
+        music_root: Path,
+        store: AudioStore,
+        library: LibraryIndex = None,
+        journal_path: Path = Path("./journal.db"),
+        metadata_workers: int = 4,
+        download_workers: int = 4,
+        remux_workers: int = None,
+        tag_workers: int = 2,
+        queue_size: int = 8,
+        lyrics: bool = False,
+        lyrics_workers: int = 2,
+        force: bool = False,
+        prune: bool = False,
+        report_path: Path = None,
+        prometheus_path: Path = None,
+    ):
+        self.downloader_song = downloader_song
+        self.downloader = downloader_song.downloader
+        self.spotify_api = downloader_song.downloader.spotify_api
+        self.metrics = downloader_song.downloader.spotify_api.metrics
+        self.music_root = music_root
+        self.store = store
+        self.library = library if library is not None else LibraryIndex(music_root)
+        self.journal_path = journal_path
+        self.metadata_workers = metadata_workers
+        self.download_workers = download_workers
+        self.remux_workers = remux_workers
+        self.tag_workers = tag_workers
+        self.queue_size = queue_size
+        self.lyrics = lyrics
+        self.lyrics_workers = lyrics_workers
+        self.force = force
+        self.prune = prune
+        self.report_path = report_path
+        self.prometheus_path = prometheus_path
+        self.has_cdm = False
+
+    def get_sources(
+        self,
+        result: SyncResult,
+        batch_entries: list[tuple[str, str]],
+        manifests: dict[Path, SyncManifest],
+        snapshot_ids: dict[str, str] = None,
+    ):
+        snapshot_ids = snapshot_ids or {}
+        try:
+            with self.metrics.time("tracks"):
+                self.downloader.prefetch_tracks(
+                    [source_url for source_url, _ in batch_entries]
+                )
+        except Exception as e:
+            logger.warning(f"Failed to batch track metadata, falling back: {e}")
+        for source_url, source_foldername in batch_entries:
+            # Create the folder if it doesn't exist
+            folder_path = self.music_root / source_foldername
+            os.makedirs(folder_path, exist_ok=True)
+            if folder_path not in manifests:
+                manifests[folder_path] = SyncManifest(folder_path)
+            source = SyncSource(
+                url=source_url,
+                folder_path=folder_path,
+                manifest=manifests[folder_path],
+            )
+            try:
+                source.url_info = self.downloader.get_url_info(source_url)
+                if source.url_info.type == "playlist":
+                    source.snapshot_id = snapshot_ids.get(source_url)
+                    if source.snapshot_id is None:
+                        with self.metrics.time("snapshot"):
+                            source.snapshot_id = self.spotify_api.get_playlist_snapshot_id(
+                                source.url_info.id
+                            )
+                if not self.force and source.manifest.is_unchanged(
+                    source.url_info.id, source.snapshot_id
+                ):
+                    logger.info(f"{source_url} is unchanged since the last sync, skipping")
+                    self.metrics.increment("sources_unchanged")
+                    continue
+                if source.snapshot_id is not None:
+                    self.spotify_api.expire_playlist(
+                        source.url_info.id, source.snapshot_id
+                    )
+            except Exception as e:
+                logger.error(f'Failed to get {source_url} Error: {e}')
+                self.metrics.increment("sources_failed")
+                result.failed_urls.append(source_url)
+                continue
+            result.sources.append(source)
+
+    def iter_changes(
+        self,
+        result: SyncResult,
+    ) -> Iterator[tuple[SyncSource, list[DownloadQueueItem]]]:
+        logger.debug("Queuing songs...")
+        for source in result.sources:
+            source.diff = ManifestDiff()
+            try:
+                for changes in source.manifest.iter_diff(
+                    source.url_info.id,
+                    self.downloader.iter_download_queue(source.url_info),
+                    source.diff,
+                ):
+                    if changes:
+                        yield source, changes
+            except Exception as e:
+                logger.error(f'Failed to get {source.url} Error: {e}')
+                self.metrics.increment("sources_failed")
+                result.failed_urls.append(source.url)
+                continue
+            logger.info(
+                f"{source.url}: {len(source.diff.added)} new, {len(source.diff.changed)} "
+                f"changed and {len(source.diff.removed)} removed tracks"
+            )
+            self.remove_tracks(source)
+
+    def remove_tracks(self, source: SyncSource):
+        for track_id in source.diff.removed:
+            if not self.prune:
+                logger.info(
+                    f"Track {source.manifest.tracks[track_id]['path']} is no longer in {source.url}"
+                )
+                continue
+            removed_path = source.manifest.remove_source(source.url_info.id, track_id)
+            if removed_path is not None:
+                logger.info(f'Removing "{removed_path}"')
+                removed_path.unlink(missing_ok=True)
+                self.downloader_song.get_lrc_path(removed_path).unlink(missing_ok=True)
+                self.library.remove(removed_path)
+                self.store.release(track_id, self.downloader_song.codec, removed_path)
+
+    def sync(
+        self,
+        batch_entries: list[tuple[str, str]],
+        snapshot_ids: dict[str, str] = None,
+    ) -> SyncResult:
+        manifests = {}
+        result = SyncResult()
+        self.get_sources(result, batch_entries, manifests, snapshot_ids)
+        if result.sources:
+            if not self.has_cdm:
+                logger.debug("Setting up CDM")
+                self.downloader.set_cdm()
+                self.has_cdm = True
+            with self.metrics.time("library_scan"):
+                self.library.scan()
+            journal = JobJournal(self.journal_path)
+            try:
+                song_pipeline = SongPipeline(
+                    self.downloader_song,
+                    metadata_workers=self.metadata_workers,
+                    download_workers=self.download_workers,
+                    remux_workers=self.remux_workers,
+                    tag_workers=self.tag_workers,
+                    queue_size=self.queue_size,
+                    journal=journal,
+                    lyrics=self.lyrics,
+                    lyrics_workers=self.lyrics_workers,
+                    store=self.store,
+                    library=self.library,
+                )
+                song_pipeline.run(self.iter_changes(result))
+                result.failures = song_pipeline.failed
+                failed_source_ids = {
+                    destination.source.url_info.id
+                    for failure in song_pipeline.failed
+                    for destination in failure.job.destinations
+                }
+                for failure in song_pipeline.failed:
+                    logger.warning(
+                        f'Failed track {failure.job.track.id} "{failure.job.track.name}" '
+                        f"during {failure.stage}: {failure.error}"
+                    )
+                for source in result.sources:
+                    source.manifest.set_snapshot(
+                        source.url_info.id,
+                        source.snapshot_id
+                        if source.url_info.id not in failed_source_ids
+                        and source.url not in result.failed_urls
+                        else None,
+                    )
+            except Exception as e:
+                logger.error(f'Failed to download song! Error: {e}')
+                result.failed_urls.extend(source.url for source in result.sources)
+            finally: # Clean up
+                for manifest in manifests.values():
+                    manifest.save()
+                self.store.save()
+                self.library.save()
+                # Partial files of unfinished tracks are kept so the next run can resume them
+                journal.collect_garbage(self.downloader.temp_path)
+                journal.close()
+            logger.info("Completed download")
+        self.write_report(result)
+        return result
+
+    def write_report(self, result: SyncResult):
+        http_downloader = self.downloader_song.http_downloader
+        bandwidth_scheduler = self.downloader_song.bandwidth_scheduler
+        if http_downloader.bytes_downloaded:
+            logger.debug(
+                "Native downloader throughput: "
+                f"{http_downloader.bytes_per_second / 1024 / 1024:.2f} MiB/s"
+            )
+            logger.debug(f"CDN hosts: {http_downloader.get_host_summary()}")
+        if bandwidth_scheduler.bytes:
+            logger.debug(
+                "Achieved download throughput: "
+                f"{bandwidth_scheduler.bytes_per_second / 1024 / 1024:.2f} MiB/s"
+            )
+        logger.debug(f"Request rate limiter: {self.spotify_api.rate_limiter.metrics()}")
+        logger.debug(f"Metadata cache stats: {self.spotify_api.cache.stats()}")
+        logger.debug(f"Cover cache stats: {self.downloader.image_cache.stats()}")
+        if self.report_path is not None:
+            self.metrics.write_report(
+                self.report_path,
+                {
+                    "failures": [
+                        {
+                            "track_id": failure.job.track.id,
+                            "name": failure.job.track.name,
+                            "stage": failure.stage,
+                            "error": failure.error,
+                        }
+                        for failure in result.failures
+                    ],
+                    "rate_limiter": self.spotify_api.rate_limiter.metrics(),
+                    "metadata_cache": self.spotify_api.cache.stats(),
+                    "cover_cache": self.downloader.image_cache.stats(),
+                    "cdn_hosts": http_downloader.get_host_summary(),
+                    "bandwidth": bandwidth_scheduler.metrics(),
+                },
+            )
+        if self.prometheus_path is not None:
+            self.metrics.write_prometheus(self.prometheus_path)
@@ -0,0 +1,207 @@
+from __future__ import annotations
+
+import http.server
+import json
+import logging
+import threading
+import time
+from typing import Callable
+
+from .models import SyncResult
+from .syncer import Syncer
+
+logger = logging.getLogger(__name__)
+
+
+class Watcher:
+    def __init__(
+        self,
+        syncer: Syncer,
+        batch_entries: list[tuple[str, str]],
+        interval: float = 300.0,
+        status_host: str = "127.0.0.1",
+        status_port: int = None,
+        on_sync: Callable[[SyncResult], None] = None,
+    ):
+        self.syncer = syncer
+        self.spotify_api = syncer.spotify_api
+        self.downloader = syncer.downloader
+        self.bandwidth_scheduler = syncer.downloader_song.bandwidth_scheduler
+        self.batch_entries = batch_entries
+        self.interval = interval
+        self.status_host = status_host
+        self.status_port = status_port
+        self.on_sync = on_sync
+        self.synced_snapshot_ids = {}
+        self.state = "starting"
+        self.last_poll_at = None
+        self.last_sync_at = None
+        self.next_poll_at = None
+        self.last_result = None
+        self.last_error = None
+        self.status_server = None
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+
+    def _set_state(self, state: str, **kwargs):
+        with self._lock:
+            self.state = state
+            for key, value in kwargs.items():
+                setattr(self, key, value)
+
+    def get_changed_entries(self) -> tuple[list[tuple[str, str]], dict[str, str]]:
+        changed_entries = []
+        snapshot_ids = {}
+        for source_url, source_foldername in self.batch_entries:
+            try:
+                url_info = self.downloader.get_url_info(source_url)
+                if url_info.type == "playlist":
+                    snapshot_ids[source_url] = self.spotify_api.get_playlist_snapshot_id(
+                        url_info.id
+                    )
+            except Exception as e:
+                logger.error(f"Failed to poll {source_url} Error: {e}")
+                continue
+            if (
+                source_url not in self.synced_snapshot_ids
+                or self.synced_snapshot_ids[source_url] != snapshot_ids.get(source_url)
+            ):
+                changed_entries.append((source_url, source_foldername))
+        return changed_entries, snapshot_ids
+
+    def poll(self):
+        self._set_state("polling", last_poll_at=time.time())
+        self.spotify_api.refresh_token()
+        changed_entries, snapshot_ids = self.get_changed_entries()
+        if not changed_entries:
+            logger.debug("No playlist changed since the last poll")
+            return
+        logger.info(f"{len(changed_entries)} source(s) changed, syncing")
+        self._set_state("syncing")
+        self.syncer.metrics.reset()
+        self.bandwidth_scheduler.reset()
+        result = self.syncer.sync(changed_entries, snapshot_ids)
+        failed_urls = set(result.failed_urls) | {
+            destination.source.url
+            for failure in result.failures
+            for destination in failure.job.destinations
+        }
+        for source_url, _ in changed_entries:
+            if source_url not in failed_urls:
+                self.synced_snapshot_ids[source_url] = snapshot_ids.get(source_url)
+        self._set_state(
+            "syncing",
+            last_sync_at=time.time(),
+            last_result={
+                "sources": len(result.sources),
+                "failed_tracks": len(result.failures),
+                "failed_sources": len(result.failed_urls),
+                "counters": dict(self.syncer.metrics.counters),
+            },
+        )
+        if result.sources and self.on_sync is not None:
+            self.on_sync(result)
+
+    def run(self):
+        self.start_status_server()
+        try:
+            while not self._stop.is_set():
+                try:
+                    self.poll()
+                    self._set_state("idle", last_error=None)
+                except Exception as e:
+                    logger.error(f"Watch poll failed: {e}")
+                    self._set_state("idle", last_error=str(e))
+                with self._lock:
+                    self.next_poll_at = time.time() + self.interval
+                self._wake.wait(self.interval)
+                self._wake.clear()
+        except KeyboardInterrupt:
+            logger.info("Stopping watch mode")
+        finally:
+            self.stop_status_server()
+
+    def trigger(self):
+        self._wake.set()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+
+    def get_status(self) -> dict:
+        with self._lock:
+            return {
+                "state": self.state,
+                "last_poll_at": self.last_poll_at,
+                "last_sync_at": self.last_sync_at,
+                "next_poll_at": self.next_poll_at,
+                "last_error": self.last_error,
+                "last_result": self.last_result,
+                "token_expires_at": self.spotify_api.token_expires_at,
+                "bandwidth": self.bandwidth_scheduler.metrics(),
+                "sources": [
+                    {
+                        "url": source_url,
+                        "folder": source_foldername,
+                        "synced": source_url in self.synced_snapshot_ids,
+                        "snapshot_id": self.synced_snapshot_ids.get(source_url),
+                    }
+                    for source_url, source_foldername in self.batch_entries
+                ],
+            }
+
+    def get_status_handler(self) -> type:
+        watcher = self
+
+        class StatusHandler(http.server.BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def send_json(self, status: int, body: dict):
+                data = json.dumps(body).encode("utf8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                if self.path == "/status":
+                    self.send_json(200, watcher.get_status())
+                else:
+                    self.send_json(404, {"error": "not found"})
+
+            def do_POST(self):
+                if self.path == "/sync":
+                    watcher.trigger()
+                    self.send_json(202, {"state": "triggered"})
+                elif self.path == "/stop":
+                    watcher.stop()
+                    self.send_json(202, {"state": "stopping"})
+                else:
+                    self.send_json(404, {"error": "not found"})
+
+        return StatusHandler
+
+    def start_status_server(self):
+        if self.status_port is None:
+            return
+        self.status_server = http.server.ThreadingHTTPServer(
+            (self.status_host, self.status_port), self.get_status_handler()
+        )
+        threading.Thread(
+            target=self.status_server.serve_forever,
+            name="status-server",
+            daemon=True,
+        ).start()
+        logger.info(
+            f"Status endpoint listening on http://{self.status_host}:"
+            f"{self.status_server.server_address[1]}/status"
+        )
+
+    def stop_status_server(self):
+        if self.status_server is not None:
+            self.status_server.shutdown()
+            self.status_server.server_close()
+            self.status_server = None
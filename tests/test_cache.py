@@ -0,0 +1,113 @@
+from __future__ import annotations
+
+import types
+
+import pytest
+
+from spotify_downloader import cache as cache_module
+from spotify_downloader.cache import MetadataCache
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1_000_000.0
+
+    def time(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch) -> FakeClock:
+    clock = FakeClock()
+    monkeypatch.setattr(cache_module, "time", types.SimpleNamespace(time=clock.time))
+    return clock
+
+
+def get_accessed_at(cache: MetadataCache, endpoint: str, key: str) -> float:
+    return cache.connection.execute(
+        "SELECT accessed_at FROM entries WHERE endpoint = ? AND key = ?",
+        (endpoint, key),
+    ).fetchone()[0]
+
+
+def test_entry_expires_after_ttl(clock: FakeClock):
+    cache = MetadataCache(ttls={"track": 60})
+    cache.set("track", "a", {"id": "a"})
+    clock.now += 59
+    assert cache.get("track", "a") == {"id": "a"}
+    clock.now += 2
+    assert cache.get("track", "a", None) is None
+    assert cache.stats()["entries"] == 0
+    assert cache.stats()["size"] == 0
+    assert cache.stats()["hits"] == {"track": 1}
+    assert cache.stats()["misses"] == {"track": 1}
+
+
+def test_ttl_is_per_endpoint(clock: FakeClock):
+    cache = MetadataCache(ttls={"playlist": 10, "track": 100})
+    cache.set("playlist", "a", 1)
+    cache.set("track", "a", 2)
+    clock.now += 50
+    assert cache.get("playlist", "a", None) is None
+    assert cache.get("track", "a") == 2
+
+
+def test_evicts_least_recently_used_over_max_entries(clock: FakeClock):
+    cache = MetadataCache(max_entries=2)
+    cache.set("track", "a", 1)
+    clock.now += 1
+    cache.set("track", "b", 2)
+    clock.now += cache.ACCESS_GRANULARITY + 1
+    assert cache.get("track", "a") == 1
+    clock.now += 1
+    cache.set("track", "c", 3)
+    assert cache.get("track", "a") == 1
+    assert cache.get("track", "b", None) is None
+    assert cache.get("track", "c") == 3
+    assert cache.stats()["entries"] == 2
+
+
+def test_evicts_over_max_size(clock: FakeClock):
+    cache = MetadataCache(max_size=25)
+    cache.set("track", "a", "x" * 10)
+    clock.now += 1
+    cache.set("track", "b", "y" * 10)
+    assert cache.stats()["size"] == 24
+    clock.now += 1
+    cache.set("track", "c", "z" * 10)
+    assert cache.get("track", "a", None) is None
+    assert cache.get("track", "b") == "y" * 10
+    assert cache.get("track", "c") == "z" * 10
+    assert cache.stats()["entries"] == 2
+    assert cache.stats()["size"] == 24
+
+
+def test_replacing_entry_keeps_accounting(clock: FakeClock):
+    cache = MetadataCache()
+    cache.set("track", "a", "x" * 10)
+    cache.set("track", "a", "x" * 20)
+    assert cache.stats()["entries"] == 1
+    assert cache.stats()["size"] == 22
+
+
+def test_hit_only_touches_entry_once_per_granularity(clock: FakeClock):
+    cache = MetadataCache()
+    cache.set("track", "a", 1)
+    created_at = clock.now
+    clock.now += cache.ACCESS_GRANULARITY - 1
+    cache.get("track", "a")
+    assert get_accessed_at(cache, "track", "a") == created_at
+    clock.now += 2
+    cache.get("track", "a")
+    assert get_accessed_at(cache, "track", "a") == clock.now
+
+
+def test_persists_entries_across_instances(tmp_path, clock: FakeClock):
+    path = tmp_path / "cache.db"
+    cache = MetadataCache(path)
+    cache.set("track", "a", {"id": "a"})
+    cache.close()
+    cache = MetadataCache(path)
+    assert cache.stats()["entries"] == 1
+    assert cache.get("track", "a") == {"id": "a"}
+    cache.close()